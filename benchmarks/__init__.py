@@ -0,0 +1 @@
+"""Benchmarks for the load and tree pipeline, run them with `python -m benchmarks`."""
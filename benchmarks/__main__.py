@@ -0,0 +1,373 @@
+"""
+Runs the benchmarks and compares their results.
+
+    python -m benchmarks run -o new.json
+    python -m benchmarks compare old.json new.json
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from copy import copy
+from typing import Any, Callable, Dict, Tuple
+
+import click
+import igraph
+import numpy as np
+from igraph import Graph
+
+import sap
+from sap import (
+    LOOP_POLICIES,
+    LOOPS_COMPONENTS,
+    NUMBER_POLICIES,
+    Collection,
+    Sap,
+    _break_loops,
+    _largest,
+    load,
+)
+from sap.widget import Widget, _formatted_reference
+
+from benchmarks.synthetic import collection_file, deep_graph
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), "..", "example")
+EXAMPLE_FILES = ("sample.isi", "bit-pattern-savedrecs.txt")
+
+
+def _measure(function: Callable[[], Any], repeat: int) -> Tuple[Any, Dict]:
+    """
+    Runs a function once to get its result and peak memory, as traced by
+    `tracemalloc` (which doesn't see what igraph allocates on its own), and
+    then `repeat` times more to get its best wall time.
+    """
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return result, {"seconds": min(seconds), "peak_memory": peak}
+
+
+def _case(
+    open_sources, sapper: Sap, loops: str, repeat: int, approximate: float
+) -> Dict:
+    """
+    Measures every stage of the pipeline on a set of sources, each stage works
+    on the result of the previous one. `load` includes parsing the sources and
+    the stages after it work on the largest component, like the CLI. The
+    ``approximate`` stage grows the tree with that error budget.
+    """
+    stages = {}
+
+    pairs, stages["parse"] = _measure(
+        lambda: list(Collection(*open_sources()).citation_pairs()), repeat
+    )
+    graphs, stages["load"] = _measure(
+        lambda: list(load(Collection(*open_sources()), loops=loops)), repeat
+    )
+
+    labels = {(a.label, b.label) for a, b in pairs if a.label != b.label}
+    cyclic = Graph.TupleList(labels, directed=True)
+    _, stages["break_loops"] = _measure(lambda: _break_loops(cyclic, loops), repeat)
+
+    graph = _largest(graphs)
+    rooted, stages["root"] = _measure(lambda: sapper.root(graph), repeat)
+    leafed, stages["leaf"] = _measure(lambda: sapper.leaf(rooted), repeat)
+    sapped, stages["sap"] = _measure(lambda: sapper.sap(leafed), repeat)
+    _, stages["trunk"] = _measure(lambda: sapper.trunk(sapped), repeat)
+    tree, stages["tree"] = _measure(lambda: sapper.tree(graph), repeat)
+    sampler = copy(sapper)
+    sampler.approximate = approximate
+    _, stages["approximate"] = _measure(lambda: sampler.tree(graph), repeat)
+    _, stages["widget"] = _measure(lambda: Widget(tree)._repr_html_(), repeat)
+    _, stages["widget_cold"] = _measure(lambda: _cold_widget(tree), repeat)
+
+    return {
+        "vertices": graph.vcount(),
+        "edges": graph.ecount(),
+        "cycles": not cyclic.is_dag(),
+        "stages": stages,
+    }
+
+
+def _cold_widget(tree: Graph) -> str:
+    """
+    Renders the widget of a tree without the references formatted before.
+    """
+    _formatted_reference.cache_clear()
+    return Widget(tree)._repr_html_()
+
+
+def _numbers(graph: Graph, engine: str, repeat: int) -> Dict:
+    """
+    Measures growing the tree of a graph with every policy for the numbers,
+    and checks that they rank the roots, trunk and leaves as exact integers
+    do. The policies that overflow are left out.
+    """
+    stages = {}
+    same_ranking = {}
+    exact = None
+    for numbers in NUMBER_POLICIES:
+        sapper = Sap(engine=engine, numbers=numbers)
+        try:
+            tree, stages[numbers] = _measure(
+                lambda: sapper.tree(graph, compact=True), repeat
+            )
+        except OverflowError:
+            click.echo(f"The {numbers} numbers overflow", err=True)
+            continue
+        ranking = [
+            [tree.labels[i] for i in tree.ranked(part)]
+            for part in ("root", "trunk", "leaf")
+        ]
+        exact = exact or ranking
+        same_ranking[numbers] = ranking == exact
+    return {
+        "vertices": graph.vcount(),
+        "edges": graph.ecount(),
+        "stages": stages,
+        "same_ranking": same_ranking,
+    }
+
+
+STARTUP_COMMANDS = {
+    "import": [sys.executable, "-c", "import sap"],
+    "help": [sys.executable, "-m", "sap", "--help"],
+}
+
+
+def _startup(repeat: int) -> Dict:
+    """
+    Measures the wall time of ``import sap`` and ``sap --help`` in fresh
+    interpreters, memory isn't measured.
+    """
+    stages = {}
+    for name, command in STARTUP_COMMANDS.items():
+        seconds = []
+        # The first run warms up the bytecode and disk caches
+        for _ in range(repeat + 1):
+            start = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+            seconds.append(time.perf_counter() - start)
+        stages[name] = {"seconds": min(seconds[1:]), "peak_memory": 0}
+    return {"stages": stages}
+
+
+@click.group()
+def main():
+    """
+    Benchmarks for python-sap, they run offline on the bundled examples and on
+    synthetic collections.
+    """
+
+
+@main.command()
+@click.option("--output", "-o", type=click.File("w"), default="-")
+@click.option(
+    "--repeat", "-n", default=3, show_default=True, help="Timed runs per stage"
+)
+@click.option("--articles", default=1000, show_default=True)
+@click.option("--references", default=20, show_default=True)
+@click.option("--components", default=2, show_default=True)
+@click.option(
+    "--cycles",
+    default=0.01,
+    show_default=True,
+    help="Probability of citing a newer article",
+)
+@click.option("--first-year", default=1990, show_default=True)
+@click.option("--last-year", default=2020, show_default=True)
+@click.option("--seed", default=0, show_default=True)
+@click.option(
+    "--engine",
+    type=click.Choice(sap.ENGINES),
+    default=sap.ENGINE_PYTHON,
+    show_default=True,
+)
+@click.option(
+    "--loops",
+    type=click.Choice(LOOP_POLICIES),
+    default=LOOPS_COMPONENTS,
+    show_default=True,
+)
+@click.option(
+    "--deep-layers",
+    default=200,
+    show_default=True,
+    help="Layers of the deep graph used to compare the numbers policies",
+)
+@click.option("--deep-width", default=100, show_default=True)
+@click.option(
+    "--approximate",
+    default=0.3,
+    show_default=True,
+    help="Error budget of the approximate trees",
+)
+@click.option("--no-examples", is_flag=True, default=False)
+@click.option("--no-startup", is_flag=True, default=False)
+@click.option("--no-deep", is_flag=True, default=False)
+def run(
+    output,
+    repeat,
+    articles,
+    references,
+    components,
+    cycles,
+    first_year,
+    last_year,
+    seed,
+    engine,
+    loops,
+    deep_layers,
+    deep_width,
+    approximate,
+    no_examples,
+    no_startup,
+    no_deep,
+):
+    """
+    Runs the benchmarks and writes their results as JSON.
+    """
+    sapper = Sap(engine=engine)
+    synthetic = dict(
+        articles=articles,
+        references=references,
+        components=components,
+        cycles=cycles,
+        years=(first_year, last_year),
+        seed=seed,
+    )
+    cases = {}
+    if not no_examples:
+        for name in EXAMPLE_FILES:
+            path = os.path.join(EXAMPLES, name)
+            click.echo(f"Running {name}", err=True)
+            cases[name] = _case(
+                lambda: [open(path)], sapper, loops, repeat, approximate
+            )
+    click.echo("Running synthetic", err=True)
+    cases["synthetic"] = _case(
+        lambda: [collection_file(**synthetic)], sapper, loops, repeat, approximate
+    )
+    cases["synthetic"]["bytes"] = len(collection_file(**synthetic).getvalue().encode())
+    if not no_startup:
+        click.echo("Running startup", err=True)
+        cases["startup"] = _startup(repeat)
+    if not no_deep:
+        click.echo("Running deep", err=True)
+        graph = deep_graph(layers=deep_layers, width=deep_width, seed=seed)
+        cases["deep"] = _numbers(graph, engine, repeat)
+
+    results = {
+        "environment": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "sap": sap.__version__,
+            "igraph": igraph.__version__,
+            "numpy": np.__version__,
+        },
+        "parameters": dict(
+            synthetic,
+            engine=engine,
+            loops=loops,
+            repeat=repeat,
+            deep_layers=deep_layers,
+            deep_width=deep_width,
+            approximate=approximate,
+        ),
+        "cases": cases,
+    }
+    json.dump(results, output, indent=2)
+    output.write("\n")
+    _table(cases)
+
+
+def _table(cases: Dict):
+    click.echo(f"{'case':<28}{'stage':<14}{'seconds':>10}{'peak MB':>10}", err=True)
+    for case, result in cases.items():
+        for stage, measure in result["stages"].items():
+            click.echo(
+                f"{case:<28}{stage:<14}{measure['seconds']:>10.4f}"
+                f"{measure['peak_memory'] / 2 ** 20:>10.2f}",
+                err=True,
+            )
+    for case, result in cases.items():
+        stages = result["stages"]
+        if "approximate" in stages and (
+            stages["approximate"]["seconds"] > stages["tree"]["seconds"]
+        ):
+            click.echo(f"{case}: the approximate tree is slower", err=True)
+        for numbers, same in result.get("same_ranking", {}).items():
+            if not same:
+                click.echo(f"{case}: {numbers} numbers change the ranking", err=True)
+
+
+@main.command()
+@click.argument("old", type=click.File("r"))
+@click.argument("new", type=click.File("r"))
+@click.option(
+    "--tolerance",
+    default=0.25,
+    show_default=True,
+    help="Relative slowdown (or memory growth) flagged as a regression",
+)
+@click.option(
+    "--min-seconds",
+    default=0.005,
+    show_default=True,
+    help="Ignore time differences smaller than this, they are just noise",
+)
+@click.option(
+    "--min-memory",
+    default=1.0,
+    show_default=True,
+    help="Ignore memory differences smaller than this many megabytes",
+)
+def compare(old, new, tolerance, min_seconds, min_memory):
+    """
+    Compares two benchmark runs and exits with an error on regressions.
+    """
+    old_cases = json.load(old)["cases"]
+    new_cases = json.load(new)["cases"]
+    regressions = 0
+    click.echo(f"{'case':<28}{'stage':<14}{'time':>10}{'memory':>10}")
+    for case, result in new_cases.items():
+        if case not in old_cases:
+            continue
+        for stage, measure in result["stages"].items():
+            before = old_cases[case]["stages"].get(stage)
+            if before is None:
+                continue
+            time_ratio = measure["seconds"] / max(before["seconds"], 1e-9)
+            memory_ratio = measure["peak_memory"] / max(before["peak_memory"], 1)
+            slower = (
+                time_ratio > 1 + tolerance
+                and measure["seconds"] - before["seconds"] > min_seconds
+            )
+            bigger = (
+                memory_ratio > 1 + tolerance
+                and measure["peak_memory"] - before["peak_memory"] > min_memory * 2**20
+            )
+            flag = "  REGRESSION" if slower or bigger else ""
+            regressions += bool(flag)
+            click.echo(
+                f"{case:<28}{stage:<14}{time_ratio:>9.2f}x{memory_ratio:>9.2f}x{flag}"
+            )
+    if regressions:
+        click.echo(f"{regressions} regressions", err=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
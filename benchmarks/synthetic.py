@@ -0,0 +1,157 @@
+"""
+Synthetic citation collections in the Web of Science plain text format, and
+deep citation graphs.
+"""
+
+import io
+import random
+from typing import List, Tuple
+
+from igraph import Graph
+
+HEADER = "FN Thomson Reuters Web of Science™\nVR 1.0\n"
+
+
+def _reference(author: str, year: int, journal: str, doi: str) -> str:
+    return f"{author} X, {year}, {journal}, V1, P1, DOI {doi}"
+
+
+def _record(index: int, year: int, journal: str, references: List[str]) -> str:
+    lines = [
+        "PT J",
+        f"AU Author{index}, X",
+        f"TI Synthetic article {index}",
+        f"SO {journal}",
+        f"J9 {journal}",
+        f"PY {year}",
+        "VL 1",
+        "BP 1",
+        f"DI 10.5555/art.{index}",
+    ]
+    if references:
+        lines.append(f"CR {references[0]}")
+        lines.extend(f"   {reference}" for reference in references[1:])
+    lines.append("ER")
+    return "\n".join(lines)
+
+
+def records(
+    articles: int = 1000,
+    references: int = 20,
+    components: int = 1,
+    cycles: float = 0.0,
+    years: Tuple[int, int] = (1990, 2020),
+    growth: float = 0.05,
+    seed: int = 0,
+) -> str:
+    """
+    Writes a collection of synthetic articles.
+
+    Articles are split in components that never cite each other. Every article
+    cites mostly references out of the collection, some of them far more
+    popular than others so that they end up as roots, and a few older
+    articles of its own component.
+
+    :param int articles: number of articles in the collection
+    :param int references: number of references of every article
+    :param int components: number of disconnected groups of articles
+    :param float cycles: probability that a reference points to a newer article
+        of the same component, which might close a citation cycle
+    :param years: first and last publication year of the articles
+    :param float growth: yearly growth of the number of articles
+    :param int seed: seed for the random generator
+    :return: the text of the collection
+    """
+    generator = random.Random(seed)
+    first, last = years
+    span = list(range(first, last + 1))
+    weights = [(1 + growth) ** (year - first) for year in span]
+    published = sorted(generator.choices(span, weights, k=articles))
+
+    groups: List[List[Tuple[int, int]]] = [[] for _ in range(components)]
+    for index, year in enumerate(published):
+        groups[index % components].append((index, year))
+
+    pool = max(articles // (2 * components), 1)
+    output = [HEADER.rstrip("\n")]
+    for component, group in enumerate(groups):
+        journal = f"JOURNAL {component}"
+        external = [
+            _reference(
+                f"Ref{component}n{k}",
+                generator.randint(first - 30, first),
+                journal,
+                f"10.5555/ref.{component}.{k}",
+            )
+            for k in range(pool)
+        ]
+        for position, (index, year) in enumerate(group):
+            cited = set()
+            for _ in range(references):
+                draw = generator.random()
+                if draw < cycles and position + 1 < len(group):
+                    other, other_year = group[
+                        generator.randrange(position + 1, len(group))
+                    ]
+                elif draw < cycles + 0.3 and position > 0:
+                    other, other_year = group[generator.randrange(position)]
+                else:
+                    cited.add(external[int(pool * generator.random() ** 3)])
+                    continue
+                cited.add(
+                    _reference(
+                        f"Author{other}",
+                        other_year,
+                        journal,
+                        f"10.5555/art.{other}",
+                    )
+                )
+            output.append(_record(index, year, journal, sorted(cited)))
+    output.append("EF")
+    return "\n\n".join(output)
+
+
+def collection_file(**kwargs) -> io.StringIO:
+    """
+    Same as `records` but as a file, ready to be handed to a `Collection`.
+    """
+    return io.StringIO(records(**kwargs))
+
+
+def deep_graph(
+    layers: int = 100, width: int = 100, references: int = 4, seed: int = 0
+) -> Graph:
+    """
+    Builds a citation graph ready for `Sap.tree` where every article cites
+    some of the articles of the layer before its own, the first ones of every
+    layer far more than the rest, so that the number of paths from the newest
+    articles to the oldest ones grows exponentially with the number of layers.
+
+    :param int layers: number of layers, a year each
+    :param int width: number of articles of every layer
+    :param int references: most references of every article
+    :param int seed: seed for the random generator
+    """
+    generator = random.Random(seed)
+    edges = []
+    for layer in range(1, layers):
+        for position in range(width):
+            cited = {
+                int(width * generator.random() ** 3)
+                for _ in range(min(references, width))
+            }
+            edges.extend(
+                (layer * width + position, (layer - 1) * width + other)
+                for other in cited
+            )
+    names = [f"10.5555/deep.{index}" for index in range(layers * width)]
+    return Graph(
+        n=layers * width,
+        edges=edges,
+        directed=True,
+        vertex_attrs={
+            "name": names,
+            "label": names,
+            "year": [1900 + index // width for index in range(layers * width)],
+        },
+    )
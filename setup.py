@@ -9,6 +9,7 @@ with open("README.md") as readme_file:
 
 requirements = [
     "Click>=7.0,<8",
+    "numpy>=1.17",
     "python-igraph>=0.8.0,<1",
     "wostools>=3.0.2,<4",
 ]
@@ -24,7 +25,7 @@ test_requirements = [
 setup(
     author="Juan David Alzate Cardona",
     author_email="jdalzatec@unal.edu.co",
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Environment :: Console",
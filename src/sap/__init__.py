@@ -1,10 +1,66 @@
 """Top-level package for Python SAP."""
 
+from __future__ import annotations
+
+import concurrent.futures
+import heapq
+import importlib
 import logging
-from typing import Iterator, List, Optional
+import math
+from array import array
+from collections import deque
+from copy import copy
+from decimal import Decimal
+from functools import partial
+from itertools import chain, product
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from sap.profiling import Profile, stage
+
+if TYPE_CHECKING:
+    from igraph import Graph
+    from wostools import Article, Collection
+
+
+class _LazyModule:
+    """
+    Stands for a module that is imported, with a plain import, the first time
+    one of its attributes is used, importing numpy, igraph and wostools takes
+    most of the startup time of the command line. Nothing but the imported
+    module goes to `sys.modules`, so threads can use it from the start.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+    def __repr__(self) -> str:
+        return f"<lazy module {self._name!r}>"
 
-from igraph import Graph
-from wostools import Collection
+
+np = _LazyModule("numpy")
+ig = _LazyModule("igraph")
+wostools = _LazyModule("wostools")
 
 __author__ = """Daniel Stiven Valencia Hernadez"""
 __email__ = "dsvalenciah@gmail.com"
@@ -15,6 +71,44 @@ MODE_OUT = "OUT"
 MODE_WEAK = "WEAK"
 MODE_STRONG = "STRONG"
 
+ENGINE_PYTHON = "python"
+ENGINE_NUMPY = "numpy"
+ENGINES = (ENGINE_PYTHON, ENGINE_NUMPY)
+
+LOOPS_COMPONENTS = "components"
+LOOPS_FEEDBACK = "feedback"
+LOOPS_MINIMAL = "minimal"
+LOOP_POLICIES = (LOOPS_COMPONENTS, LOOPS_FEEDBACK, LOOPS_MINIMAL)
+
+NUMBERS_EXACT = "exact"
+NUMBERS_INT64 = "int64"
+NUMBERS_FLOAT = "float"
+NUMBERS_LOG = "log"
+NUMBER_POLICIES = (NUMBERS_EXACT, NUMBERS_INT64, NUMBERS_FLOAT, NUMBERS_LOG)
+INT64_MAX = 2**63 - 1
+LOG_DIGITS = 10
+
+TREE_ATTRIBUTES = (
+    "root",
+    "extended_root",
+    "_connections",
+    "leaf",
+    "extended_leaf",
+    "_raw_sap",
+    "_root_connections",
+    "_elaborate_sap",
+    "_leaf_connections",
+    "sap",
+    "trunk",
+)
+
+SWEEP_PARAMETERS = (
+    "max_roots",
+    "min_leaf_connections",
+    "max_leaf_age",
+    "max_leaves",
+    "max_trunk",
+)
 
 logger = logging.getLogger(__name__)
 
@@ -26,66 +120,83 @@ class Sap:
         max_leaves: Optional[int] = 50,
         max_trunk: Optional[int] = 20,
         min_leaf_connections: Optional[int] = 3,
-        max_leaf_age: Optional[int] = 5,
+        max_leaf_age: Optional[int] = None,
         default_clear_graph: bool = True,
+        engine: str = ENGINE_PYTHON,
+        approximate: Optional[float] = None,
+        seed: int = 0,
+        numbers: str = NUMBERS_EXACT,
     ):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+        if numbers not in NUMBER_POLICIES:
+            raise ValueError(
+                f"Unknown numbers {numbers!r}, expected one of {NUMBER_POLICIES}"
+            )
+        if approximate is not None and approximate <= 0:
+            raise ValueError(f"The error budget must be positive, got {approximate}")
         self.max_roots = max_roots
         self.max_leaves = max_leaves
         self.max_trunk = max_trunk
         self.min_leaf_connections = min_leaf_connections
         self.max_leaf_age = max_leaf_age
         self.default_clear_graph = default_clear_graph
+        self.engine = engine
+        self.approximate = approximate
+        self.seed = seed
+        self.numbers = numbers
 
     def sap(self, graph: Graph) -> Graph:
         """
         Computes the sap of each node.
         """
         new_graph = graph.copy()
+        self._sap(new_graph, self._propagator(new_graph))
+        return new_graph
+
+    def _sap(self, graph: Graph, propagator: "_Propagator"):
         try:
-            valid_root = new_graph.vs.select(root_gt=0)
-            valid_leaves = new_graph.vs.select(leaf_gt=0)
+            valid_root = graph.vs.select(root_gt=0)
+            valid_leaves = graph.vs.select(leaf_gt=0)
         except AttributeError:
             raise TypeError("The graph needs to have a 'root' and a 'leaf' attribute")
         if not valid_root or not valid_leaves:
             raise TypeError("The graph needs to have at least some roots and leafs")
 
-        new_graph.vs["_raw_sap"] = 0
-        new_graph.vs["_root_connections"] = 0
-        valid_root["_raw_sap"] = valid_root["root"]
-        valid_root["_root_connections"] = 1
-        topological_order = new_graph.topological_sorting()
-        for index in reversed(topological_order):
-            neighbors = [n.index for n in new_graph.vs[index].neighbors(mode=MODE_OUT)]
-            if neighbors:
-                new_graph.vs[index]["_raw_sap"] = sum(
-                    new_graph.vs[neighbors]["_raw_sap"]
-                )
-                new_graph.vs[index]["_root_connections"] = sum(
-                    new_graph.vs[neighbors]["_root_connections"]
-                )
+        roots = graph.vs["root"]
+        leaves = graph.vs["leaf"]
+        raw_sap = propagator.propagate(
+            [value if value > 0 else 0 for value in roots], MODE_OUT
+        )
+        root_connections = propagator.propagate(
+            [1 if value > 0 else 0 for value in roots], MODE_OUT
+        )
+        elaborate_sap = propagator.propagate(
+            [value if value > 0 else 0 for value in leaves], MODE_IN, stored=True
+        )
+        leaf_connections = propagator.propagate(
+            [1 if value > 0 else 0 for value in leaves], MODE_IN
+        )
 
-        new_graph.vs["_elaborate_sap"] = 0
-        new_graph.vs["_leaf_connections"] = 0
-        valid_leaves["_elaborate_sap"] = valid_leaves["leaf"]
-        valid_leaves["_leaf_connections"] = 1
-        topological_order = new_graph.topological_sorting(mode=MODE_IN)
-        for index in reversed(topological_order):
-            neighbors = [n.index for n in new_graph.vs[index].neighbors(mode=MODE_IN)]
-            if neighbors:
-                new_graph.vs[index]["_elaborate_sap"] = sum(
-                    new_graph.vs[neighbors]["_elaborate_sap"]
+        if self.numbers == NUMBERS_LOG:
+            sap = np.logaddexp(
+                np.add(leaf_connections, raw_sap),
+                np.add(root_connections, elaborate_sap),
+            ).tolist()
+        else:
+            sap = [
+                leaf_conn * raw + root_conn * elaborate
+                for raw, root_conn, elaborate, leaf_conn in zip(
+                    raw_sap, root_connections, elaborate_sap, leaf_connections
                 )
-                new_graph.vs[index]["_leaf_connections"] = sum(
-                    new_graph.vs[neighbors]["_leaf_connections"]
-                )
-
-        new_graph.vs["sap"] = [
-            v["_leaf_connections"] * v["_raw_sap"]
-            + v["_root_connections"] * v["_elaborate_sap"]
-            for v in new_graph.vs
-        ]
+            ]
+            _check_overflow(sap, self.numbers)
 
-        return new_graph
+        graph.vs["_raw_sap"] = _stored(raw_sap, self.numbers)
+        graph.vs["_root_connections"] = _stored(root_connections, self.numbers)
+        graph.vs["_elaborate_sap"] = _stored(elaborate_sap, self.numbers)
+        graph.vs["_leaf_connections"] = _stored(leaf_connections, self.numbers)
+        graph.vs["sap"] = _stored(sap, self.numbers)
 
     def root(self, graph: Graph) -> Graph:
         """
@@ -94,18 +205,18 @@ class Sap:
         :return: Labeled graph with the root property.
         """
         new_graph = graph.copy()
-        valid_root = new_graph.vs.select(_outdegree_eq=0).indices
+        self._root(new_graph)
+        return new_graph
+
+    def _root(self, graph: Graph):
+        valid_root = graph.vs.select(_outdegree_eq=0).indices
 
         for attr in ("root", "extended_root"):
-            new_graph.vs[attr] = 0
-            new_graph.vs[valid_root][attr] = new_graph.vs[valid_root].indegree()
+            graph.vs[attr] = 0
+            graph.vs[valid_root][attr] = graph.vs[valid_root].indegree()
 
         if self.max_roots is not None:
-            sorted_roots = _sorted_nodes(new_graph, "root")
-            not_roots_anymore = sorted_roots[self.max_roots :]
-            new_graph.vs[not_roots_anymore]["root"] = 0
-
-        return new_graph
+            graph.vs["root"] = _keep_top(graph.vs["root"], self.max_roots)
 
     def leaf(self, graph: Graph) -> Graph:
         """
@@ -116,70 +227,91 @@ class Sap:
         :return: Labeled graph with the leaf property.
         """
         new_graph = graph.copy()
+        self._leaf(new_graph, self._propagator(new_graph))
+        return new_graph
+
+    def _leaf(self, graph: Graph, propagator: "_Propagator"):
         try:
-            valid_root = new_graph.vs.select(root_gt=0).indices
+            valid_root = graph.vs.select(root_gt=0).indices
         except AttributeError:
             raise TypeError("It's necessary to have some roots")
         if not valid_root:
             raise TypeError("It's necessary to have some roots")
 
-        new_graph.vs["_connections"] = 0
-        new_graph.vs[valid_root]["_connections"] = 1
-        topological_order = new_graph.topological_sorting()
-        for index in reversed(topological_order):
-            neighbors = [n.index for n in new_graph.vs[index].neighbors(mode=MODE_OUT)]
-            if neighbors:
-                new_graph.vs[index]["_connections"] = sum(
-                    new_graph.vs[neighbors]["_connections"]
-                )
+        graph.vs["_connections"] = _stored(
+            propagator.propagate(
+                [1 if value > 0 else 0 for value in graph.vs["root"]], MODE_OUT
+            ),
+            self.numbers,
+        )
+        self._pick_leaves(graph)
 
-        potential_leaves = new_graph.vs.select(_indegree_eq=0).indices
-        leaf_connections = new_graph.vs[potential_leaves]["_connections"]
+    def _pick_leaves(self, graph: Graph):
+        """
+        Picks the leaves out of the articles nobody cites, by their
+        connections to the roots.
 
-        for attr in ("leaf", "extended_leaf"):
-            new_graph.vs[attr] = 0
-            new_graph.vs[potential_leaves][attr] = leaf_connections
+        Leaves need at least ``min_leaf_connections`` connections and, when
+        dated, can't be more than ``max_leaf_age`` years older than the newest
+        of them. Up to version 2.0.0 the age cut untagged the newer articles
+        instead, in the graph handed to `leaf` rather than its labeled copy,
+        so it never changed the tree.
+
+        Connections are compared as stored, see `_stored`.
+        """
+        connections = _tag_array(graph.vs["_connections"])
+        potential = np.array(graph.indegree()) == 0
+        extended = np.where(potential, connections, 0)
+        leaf = extended.copy()
 
         if self.min_leaf_connections is not None:
-            not_leaves_anymore = new_graph.vs.select(leaf_lt=self.min_leaf_connections)
-            not_leaves_anymore["leaf"] = 0
+            least = self.min_leaf_connections
+            if self.numbers == NUMBERS_LOG:
+                # `_stored` takes logarithms when the numbers are
+                least = math.log(least) if least > 0 else -math.inf
+            leaf[leaf < _stored([least], self.numbers)[0]] = 0
 
         if self.max_leaf_age is not None:
-            ignored = new_graph.vs.select(year_eq=None)
-            ignored = [
-                {attr: v[attr] for attr in ignored.attributes()} for v in ignored
-            ]
-            if ignored:
-                logging.info(f"Ignoring these nodes for year calculations:\n{ignored}")
-            newest_publication_year: int = max(
-                filter(None, new_graph.vs[potential_leaves]["year"])
-            )
-            earliest_publication_year = newest_publication_year - self.max_leaf_age
-            not_leaves_anymore = graph.vs.select(
-                year_ne=None, year_gt=earliest_publication_year
-            )
-            not_leaves_anymore["leaf"] = 0
+            if "year" in graph.vs.attributes():
+                years = graph.vs["year"]
+            else:
+                years = [None] * graph.vcount()
+            dated = np.array([year is not None for year in years], dtype=bool)
+            if not dated.all() and logger.isEnabledFor(logging.INFO):
+                ignored = graph.vs[np.flatnonzero(~dated).tolist()]
+                ignored = [
+                    {attr: v[attr] for attr in ignored.attributes()} for v in ignored
+                ]
+                logger.info(f"Ignoring these nodes for year calculations:\n{ignored}")
+            years = np.array([year or 0 for year in years], dtype=np.float64)
+            dated &= years != 0
+            if (potential & dated).any():
+                earliest = years[potential & dated].max() - self.max_leaf_age
+                leaf[dated & (years < earliest)] = 0
 
-        if not any(new_graph.vs["leaf"]) and any(new_graph.vs["extended_leaf"]):
-            logging.info(
-                f"Reverting leaf cut policies, as they remove all possible leaves"
+        if not leaf.any() and extended.any():
+            logger.info(
+                "Reverting leaf cut policies, as they remove all possible leaves"
             )
-            new_graph.vs["leaf"] = new_graph.vs["extended_leaf"]
+            leaf = extended
 
+        leaf = leaf.tolist()
         if self.max_leaves is not None:
-            sorted_leaves = _sorted_nodes(new_graph, "leaf")
-            not_leaves_anymore = sorted_leaves[self.max_leaves :]
-            new_graph.vs[not_leaves_anymore]["leaf"] = 0
-
-        return new_graph
+            leaf = _keep_top(leaf, self.max_leaves)
+        graph.vs["leaf"] = leaf
+        graph.vs["extended_leaf"] = extended.tolist()
 
     def trunk(self, graph: Graph) -> Graph:
         """
         Tags leaves.
         """
         new_graph = graph.copy()
+        self._trunk(new_graph)
+        return new_graph
+
+    def _trunk(self, graph: Graph):
         try:
-            sap_nodes = new_graph.vs.select(root_eq=0, leaf_eq=0, sap_gt=0)
+            sap_nodes = graph.vs.select(root_eq=0, leaf_eq=0, sap_gt=0)
         except AttributeError:
             raise TypeError(
                 "The graph needs to have a 'root', 'leaf' and 'sap' attributes"
@@ -187,103 +319,1259 @@ class Sap:
         if not sap_nodes:
             raise TypeError("The graph needs to have at least some nodes with sap")
 
-        new_graph.vs["trunk"] = 0
+        graph.vs["trunk"] = 0
         sap_nodes["trunk"] = sap_nodes["sap"]
 
         if self.max_trunk is not None:
-            sorted_leaves = _sorted_nodes(new_graph, "trunk")
-            not_leaves_anymore = sorted_leaves[self.max_trunk :]
-            new_graph.vs[not_leaves_anymore]["trunk"] = 0
-
-        return new_graph
+            graph.vs["trunk"] = _keep_top(graph.vs["trunk"], self.max_trunk)
 
     def clear(self, graph: Graph) -> Graph:
         """
         Returns a copy of the graph clear of untagged nodes.
         """
-        graph = graph.copy()
-        graph = graph.subgraph(
+        return graph.subgraph(
             graph.vs.select(lambda v: v["root"] > 0 or v["trunk"] > 0 or v["leaf"] > 0)
         )
-        return graph
 
-    def tree(self, graph: Graph, clear: Optional[bool] = None) -> Graph:
+    def tree(
+        self,
+        graph: Graph,
+        clear: Optional[bool] = None,
+        profile: Optional[Profile] = None,
+        compact: bool = False,
+    ) -> Union[Graph, "CompactTree"]:
         """
         Computes the whole tree.
+
+        The graph is copied once and every stage labels that copy in place,
+        sharing a single topological order between the leaf and the sap
+        propagations.
+
+        :param Profile profile: gets the measurements of every stage
+        :param bool compact: return a `CompactTree` instead of a graph, the
+            copy with every vertex attribute is thrown away
+        """
+        with stage(profile, "copy", graph) as step:
+            graph = step.output = graph.copy()
+        self._grow(graph, profile)
+        cleared = (clear is not None and clear) or self.default_clear_graph
+        if compact:
+            with stage(profile, "compact", graph) as step:
+                tree = CompactTree.from_graph(graph, cleared)
+                step.output = None
+            return tree
+        if cleared:
+            with stage(profile, "clear", graph) as step:
+                graph = step.output = self.clear(graph)
+        return graph
+
+    def tree_many(
+        self,
+        graphs: Iterable[Graph],
+        workers: Optional[int] = None,
+        clear: Optional[bool] = None,
+        profile: Optional[Profile] = None,
+        compact: bool = False,
+    ) -> Iterator[Union[Graph, "CompactTree", None]]:
+        """
+        Computes the tree of every graph, in a pool of processes when asked for
+        more than one worker.
+
+        Trees come out in the same order as the graphs, with ``None`` (and a
+        logged error) for the graphs that can't grow a tree. Only a couple of
+        graphs per worker are sent to the pool at any time, and every worker
+        gets just the graph it works on.
+
+        :param graphs: graphs to work with, usually out of `load`
+        :param int workers: number of processes, ``None`` to work in process
+        :param bool clear: see `tree`
+        :param Profile profile: gets the measurements of every stage of every
+            tree, the workers send theirs back with the trees
+        :param bool compact: see `tree`, compact trees are also much cheaper to
+            send back from the workers
+        :return: iterator over the trees
+        """
+        if workers is None or workers <= 1:
+            for graph in graphs:
+                yield _tree_or_none(
+                    graph, lambda: self.tree(graph, clear, profile, compact)
+                )
+            return
+        task = partial(self.tree, clear=clear, compact=compact)
+        for graph, result in _in_pool(graphs, task, workers, profile):
+            yield _tree_or_none(graph, result)
+
+    def _grow(
+        self,
+        graph: Graph,
+        profile: Optional[Profile] = None,
+        propagators: Optional["_Propagators"] = None,
+    ):
+        if propagators is None:
+            propagators = _Propagators(graph)
+        propagator = propagators.get(self, profile)
+        with stage(profile, "root", graph):
+            self._root(graph)
+        with stage(profile, "leaf", graph):
+            self._leaf(graph, propagator)
+        with stage(profile, "sap", graph):
+            self._sap(graph, propagator)
+        with stage(profile, "trunk", graph):
+            self._trunk(graph)
+
+    def _propagator(
+        self, graph: Graph, structure: Optional[Dict[str, Any]] = None
+    ) -> "_Propagator":
+        """
+        Propagator for a graph, along a sample of its citations when growing
+        approximate trees, see `_SampledPropagator`.
+
+        :param dict structure: the topological order and plans of the graph
+        """
+        if self.approximate is None:
+            return _Propagator(graph, self.engine, self.numbers, structure)
+        return _SampledPropagator(
+            graph, self.numbers, self.approximate, self.seed, structure
+        )
+
+    def overlap(self, graph: Graph) -> Dict[str, Any]:
+        """
+        Grows the tree of a graph both exactly and approximately, to see what
+        the error budget costs on it.
+
+        :param Graph graph: graph to work with, usually out of `load`
+        :return: the error budget, the citations and sampled citations, the
+            seconds each tree took and, for ``root``, ``trunk`` and ``leaf``,
+            how many articles each tree has and how many they share
+        """
+        if self.approximate is None:
+            raise ValueError("Set an error budget to compare with the exact tree")
+        exact = copy(self)
+        exact.approximate = None
+        report: Dict[str, Any] = {
+            "error": self.approximate,
+            "edges": graph.ecount(),
+        }
+        trees = {}
+        for name, sapper in (("exact", exact), ("approximate", self)):
+            profile = Profile()
+            trees[name] = sapper.tree(graph, profile=profile, compact=True)
+            report[f"{name}_seconds"] = sum(step.seconds for step in profile.stages)
+            for measured in profile.stages:
+                if measured.name == "sample":
+                    report["sampled_edges"] = measured.edges_out
+        for part in ("root", "trunk", "leaf"):
+            found = {
+                name: {tree.labels[i] for i in tree.ranked(part)}
+                for name, tree in trees.items()
+            }
+            report[part] = {
+                "exact": len(found["exact"]),
+                "approximate": len(found["approximate"]),
+                "shared": len(found["exact"] & found["approximate"]),
+            }
+        return report
+
+    def sweep(
+        self, graph: Graph, grid: Mapping[str, Iterable[Optional[int]]]
+    ) -> Iterator[Dict]:
+        """
+        Grows the tree of a graph for every combination of some parameters.
+
+        The graph is copied and sorted once, the root and leaf connections are
+        propagated once per ``max_roots`` and the sap once per set of roots and
+        leaves, so only picking the leaves and the trunk is done for every
+        combination. Combinations come out with ``max_roots`` varying the
+        slowest and ``max_trunk`` the fastest, see `SWEEP_PARAMETERS`.
+
+        :param Graph graph: graph to work with, usually out of `load`
+        :param grid: values to try for some of `SWEEP_PARAMETERS`, the rest
+            are taken from this instance
+        :return: iterator over one dict per combination with the parameters
+            and the ``roots``, ``trunk`` and ``leaves`` labels, best first,
+            which are empty if the combination can't grow a tree
+        """
+        unknown = set(grid) - set(SWEEP_PARAMETERS)
+        if unknown:
+            raise ValueError(
+                f"Unknown parameters {sorted(unknown)}, expected {SWEEP_PARAMETERS}"
+            )
+        values = [
+            list(grid[name]) if name in grid else [getattr(self, name)]
+            for name in SWEEP_PARAMETERS
+        ]
+
+        graph = graph.copy()
+        propagator = self._propagator(graph)
+        self._root(graph)
+        extended_root = graph.vs["extended_root"]
+        names = graph.vs["name"]
+        # Only the last state is kept, since the combinations sharing it come
+        # one after the other.
+        connections: Dict[Optional[int], list] = {}
+        saps: Dict[tuple, list] = {}
+
+        for combination in product(*values):
+            params = dict(zip(SWEEP_PARAMETERS, combination))
+            sapper = copy(self)
+            vars(sapper).update(params)
+            row = dict(params, roots=[], trunk=[], leaves=[])
+            try:
+                root = extended_root
+                if sapper.max_roots is not None:
+                    root = _keep_top(extended_root, sapper.max_roots)
+                if not any(value > 0 for value in root):
+                    raise TypeError("It's necessary to have some roots")
+                graph.vs["root"] = root
+                if sapper.max_roots not in connections:
+                    counts = propagator.propagate([int(v > 0) for v in root], MODE_OUT)
+                    connections = {sapper.max_roots: _stored(counts, self.numbers)}
+                graph.vs["_connections"] = connections[sapper.max_roots]
+
+                sapper._pick_leaves(graph)
+                key = (sapper.max_roots, tuple(graph.vs["leaf"]))
+                if key not in saps:
+                    sapper._sap(graph, propagator)
+                    saps = {key: graph.vs["sap"]}
+                graph.vs["sap"] = saps[key]
+                sapper._trunk(graph)
+            except TypeError as error:
+                logger.warning(f"Can't grow a tree with {params}: {error}")
+            else:
+                for column, attr in (
+                    ("roots", "root"),
+                    ("trunk", "trunk"),
+                    ("leaves", "leaf"),
+                ):
+                    tags = graph.vs[attr]
+                    count = sum(1 for value in tags if value > 0)
+                    row[column] = [names[i] for i in top_k(tags, count)]
+            yield row
+
+    def update(
+        self,
+        graph: Graph,
+        pairs: Iterable[Tuple[Article, Article]],
+        clear: Optional[bool] = None,
+        loops: str = LOOPS_COMPONENTS,
+    ) -> Graph:
+        """
+        Updates a tree with a batch of new citation pairs.
+
+        Only the vertices that cite (for the root side) or are cited by (for
+        the leaf side) the new citations, or the roots and leaves that changed,
+        get their counts propagated again; roots, leaves and trunk are picked
+        again afterwards. When the new citations close a cycle the loops are
+        broken and the whole tree is computed again, as it is with ``log``
+        numbers and for approximate trees, whose counts come from a sample.
+
+        The result is the tree of the old graph plus the new citations, which
+        might differ from loading the whole collection again since `load` prunes
+        the references cited only once.
+
+        :param Graph graph: tree computed over a whole graph, i.e. not cleared
+        :param pairs: new ``(article, reference)`` pairs, e.g. out of
+            ``Collection.citation_pairs()``, the known ones are skipped
+        :param bool clear: see `tree`
+        :param str loops: how to break the cycles the new citations close, see
+            `load`, usually the policy the graph was loaded with
+        :return: the updated tree
         """
         graph = graph.copy()
-        graph = self.root(graph)
-        graph = self.leaf(graph)
-        graph = self.sap(graph)
-        graph = self.trunk(graph)
+        new_edges = _add_pairs(graph, pairs)
+
+        if not graph.is_dag():
+            logger.info("The new citations close some cycles, growing the tree again")
+            graph = _break_loops(graph, loops)
+            self._grow(graph)
+        elif new_edges and (
+            self.numbers == NUMBERS_LOG or self.approximate is not None
+        ):
+            self._grow(graph)
+        elif new_edges:
+            self._update(graph, new_edges)
+
         if (clear is not None and clear) or self.default_clear_graph:
             graph = self.clear(graph)
         return graph
 
+    def _update(self, graph: Graph, new_edges: List[Tuple[int, int]]):
+        old_root = graph.vs["root"]
+        old_leaf = graph.vs["leaf"]
+        citing = {source for source, _ in new_edges}
+        cited = {target for _, target in new_edges}
+
+        self._root(graph)
+        root = graph.vs["root"]
+        changed = {i for i, value in enumerate(old_root) if value != root[i]}
+        root_side = _reachable(graph, citing | changed, MODE_IN)
+        connections = graph.vs["_connections"]
+        _repropagate(
+            graph, connections, [int(v > 0) for v in root], root_side, MODE_OUT
+        )
+        graph.vs["_connections"] = connections
+
+        self._pick_leaves(graph)
+        leaf = graph.vs["leaf"]
+        if not any(value > 0 for value in root) or not any(value > 0 for value in leaf):
+            raise TypeError("The graph needs to have at least some roots and leafs")
+        changed = {i for i, value in enumerate(old_leaf) if value != leaf[i]}
+        leaf_side = _reachable(graph, cited | changed, MODE_OUT)
+
+        counts = {}
+        for attr, initial, mode, vertices in (
+            ("_raw_sap", [max(v, 0) for v in root], MODE_OUT, root_side),
+            ("_root_connections", [int(v > 0) for v in root], MODE_OUT, root_side),
+            ("_elaborate_sap", [max(v, 0) for v in leaf], MODE_IN, leaf_side),
+            ("_leaf_connections", [int(v > 0) for v in leaf], MODE_IN, leaf_side),
+        ):
+            counts[attr] = graph.vs[attr]
+            _repropagate(graph, counts[attr], initial, vertices, mode)
+            graph.vs[attr] = counts[attr]
+
+        sap = graph.vs["sap"]
+        for index in set(root_side) | set(leaf_side):
+            sap[index] = (
+                counts["_leaf_connections"][index] * counts["_raw_sap"][index]
+                + counts["_root_connections"][index] * counts["_elaborate_sap"][index]
+            )
+        for values in (connections, sap, *counts.values()):
+            _check_overflow(values, self.numbers)
+        graph.vs["sap"] = sap
+        self._trunk(graph)
+
+
+class CompactTree:
+    """
+    A tree kept as plain arrays instead of a graph: its vertices, their tags
+    and the citations between them, see `Sap.tree`. The article metadata is
+    only read, with `join` or `to_graph`, out of the graph the tree was grown
+    from when it's needed.
+
+    :ivar ids: index of every vertex in the graph the tree was grown from
+    :ivar labels: label of every vertex
+    :ivar root: root tag of every vertex, also ``leaf``, ``trunk`` and ``sap``
+    :ivar edges: ``(citing, cited)`` positions of every citation in the tree
+    """
+
+    __slots__ = ("ids", "labels", "root", "leaf", "trunk", "sap", "edges")
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        labels: List[str],
+        root: np.ndarray,
+        leaf: np.ndarray,
+        trunk: np.ndarray,
+        sap: np.ndarray,
+        edges: np.ndarray,
+    ):
+        self.ids = ids
+        self.labels = labels
+        self.root = root
+        self.leaf = leaf
+        self.trunk = trunk
+        self.sap = sap
+        self.edges = edges
+
+    @classmethod
+    def from_graph(cls, graph: Graph, clear: bool = True) -> "CompactTree":
+        """
+        Takes the tags out of a tree, of its tagged vertices only if asked to
+        clear it.
+        """
+        tags = {attr: _tag_array(graph.vs[attr]) for attr in ("root", "leaf", "trunk")}
+        edges = _edge_array(graph)
+        if clear:
+            ids = np.flatnonzero(
+                (tags["root"] > 0) | (tags["trunk"] > 0) | (tags["leaf"] > 0)
+            )
+            positions = np.full(graph.vcount(), -1, dtype=np.int64)
+            positions[ids] = np.arange(len(ids))
+            edges = positions[edges]
+            edges = edges[(edges >= 0).all(axis=1)]
+        else:
+            ids = np.arange(graph.vcount())
+        names = graph.vs["name"]
+        sap = graph.vs["sap"]
+        return cls(
+            ids=ids,
+            labels=[names[i] for i in ids.tolist()],
+            sap=_tag_array([sap[i] for i in ids.tolist()]),
+            edges=edges.astype(np.int32 if len(ids) < 2**31 else np.int64),
+            **{attr: values[ids] for attr, values in tags.items()},
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def ranked(self, part: str) -> List[int]:
+        """
+        Positions of the vertices tagged as ``root``, ``trunk`` or ``leaf``,
+        best first.
+        """
+        values = getattr(self, part)
+        return top_k(values, int(np.count_nonzero(values > 0)))
+
+    def join(self, graph: Graph, *fields: str) -> Dict[str, list]:
+        """
+        Reads some vertex attributes, all of them by default, of the graph the
+        tree was grown from for the vertices of the tree.
+        """
+        vertices = graph.vs[self.ids.tolist()]
+        return {field: vertices[field] for field in fields or graph.vs.attributes()}
+
+    def to_graph(self, graph: Optional[Graph] = None, *fields: str) -> Graph:
+        """
+        Builds the tree as a graph, with the metadata of the graph the tree was
+        grown from if given, see `join`.
+
+        :param Graph graph: graph the tree was grown from
+        :return: same as `Sap.tree` without ``compact``, except for the
+            intermediate counts
+        """
+        vertex_attrs = {} if graph is None else self.join(graph, *fields)
+        vertex_attrs.update(
+            name=self.labels,
+            root=self.root.tolist(),
+            leaf=self.leaf.tolist(),
+            trunk=self.trunk.tolist(),
+            sap=self.sap.tolist(),
+        )
+        return ig.Graph(
+            n=len(self),
+            edges=self.edges.tolist(),
+            directed=True,
+            vertex_attrs=vertex_attrs,
+        )
+
+
+def _tag_array(values: List[int]) -> np.ndarray:
+    """
+    Tags as an array, of floats when some are, of python objects when integer
+    tags don't fit in 64 bits.
+    """
+    array = np.array(values)
+    if array.dtype.kind == "i":
+        return array.astype(np.int64, copy=False)
+    # Integers between 2 ** 63 and 2 ** 64 also come out as floats
+    if array.dtype.kind == "f" and any(isinstance(value, float) for value in values):
+        return array
+    try:
+        return np.array(values, dtype=np.int64)
+    except OverflowError:
+        return np.array(values, dtype=object)
+
+
+def trees(
+    graph: Graph,
+    sappers: Mapping[str, Sap],
+    clear: Optional[bool] = None,
+    profile: Optional[Profile] = None,
+    compact: bool = False,
+) -> Dict[str, Union[Graph, CompactTree, None]]:
+    """
+    Grows the tree of a graph for several configurations at once.
+
+    The graph is copied and sorted once and the configurations share their
+    propagators, which remember the counts they propagate, so e.g. the
+    connections to the roots are counted once for all the configurations
+    with the same roots. Remembered counts take memory, a list per set of
+    initial values, until every tree is grown.
+
+    :param Graph graph: graph to work with, usually out of `load`
+    :param sappers: the configurations by name
+    :param bool clear: see `Sap.tree`, otherwise every configuration clears
+        its tree as set by ``default_clear_graph``
+    :param Profile profile: gets the measurements of every stage of every
+        tree
+    :param bool compact: see `Sap.tree`
+    :return: the trees by configuration name, in the same order, ``None``
+        (and a logged error) for the configurations that can't grow a tree
+    """
+    with stage(profile, "copy", graph) as step:
+        working = step.output = graph.copy()
+    propagators = _Propagators(working)
+    grown: Dict[str, Union[Graph, CompactTree, None]] = {}
+    for name, sapper in sappers.items():
+        try:
+            sapper._grow(working, profile, propagators)
+        except TypeError:
+            logger.exception(
+                f"There was an error growing the {name!r} tree of the graph\n"
+                f"{graph.summary()}"
+            )
+            grown[name] = None
+            continue
+        cleared = (clear is not None and clear) or sapper.default_clear_graph
+        if compact:
+            with stage(profile, "compact", working) as step:
+                grown[name] = CompactTree.from_graph(working, cleared)
+                step.output = None
+        elif cleared:
+            with stage(profile, "clear", working) as step:
+                grown[name] = step.output = sapper.clear(working)
+        else:
+            with stage(profile, "copy", working) as step:
+                grown[name] = step.output = working.copy()
+    return grown
+
 
-def load(collection: Collection) -> Iterator[Graph]:
+def trees_many(
+    graphs: Iterable[Graph],
+    sappers: Mapping[str, Sap],
+    workers: Optional[int] = None,
+    clear: Optional[bool] = None,
+    profile: Optional[Profile] = None,
+    compact: bool = False,
+) -> Iterator[Dict[str, Union[Graph, CompactTree, None]]]:
+    """
+    Grows the trees of every graph for several configurations, see `trees`,
+    in a pool of processes like `Sap.tree_many` when asked for more than one
+    worker.
+
+    :return: iterator over the trees of every graph by configuration name
+    """
+    if workers is None or workers <= 1:
+        for graph in graphs:
+            yield trees(graph, sappers, clear, profile, compact)
+        return
+    task = partial(trees, sappers=sappers, clear=clear, compact=compact)
+    for _, result in _in_pool(graphs, task, workers, profile):
+        yield result()
+
+
+def _in_pool(
+    graphs: Iterable[Graph],
+    task: Callable[..., Any],
+    workers: int,
+    profile: Optional[Profile] = None,
+) -> Iterator[Tuple[Graph, Callable[[], Any]]]:
+    """
+    Runs ``task(graph)`` for every graph in a pool of processes, with only a
+    couple of graphs per worker sent to the pool at any time.
+
+    :param Profile profile: the task gets a profile of its own and the
+        measurements it sends back are added to this one
+    :return: iterator over the graphs, in order, and functions that get the
+        result of the task for them
+    """
+
+    def collect(future: concurrent.futures.Future) -> Any:
+        if profile is None:
+            return future.result()
+        result, measured = future.result()
+        profile.extend(measured)
+        return result
+
+    if profile is not None:
+        task = partial(_profiled, task)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending: Deque[Tuple[Graph, concurrent.futures.Future]] = deque()
+        for graph in graphs:
+            pending.append((graph, executor.submit(task, graph)))
+            if len(pending) >= 2 * workers:
+                graph, future = pending.popleft()
+                yield graph, partial(collect, future)
+        while pending:
+            graph, future = pending.popleft()
+            yield graph, partial(collect, future)
+
+
+def _profiled(task: Callable[..., Any], graph: Graph) -> Tuple[Any, Profile]:
+    profile = Profile()
+    return task(graph, profile=profile), profile
+
+
+def _tree_or_none(graph: Graph, compute: Callable[[], Graph]) -> Optional[Graph]:
+    try:
+        return compute()
+    except TypeError:
+        logger.exception(f"There was an error processing the graph\n{graph.summary()}")
+        return None
+
+
+def _add_pairs(
+    graph: Graph, pairs: Iterable[Tuple[Article, Article]]
+) -> List[Tuple[int, int]]:
+    """
+    Adds the unknown vertices and citations of some citation pairs to a graph.
+
+    New vertices get the metadata the graph already has plus zeros for the sap
+    counts.
+
+    :return: the new edges
+    """
+    ids = {label: index for index, label in enumerate(graph.vs["name"])}
+    nodes: Dict[int, Article] = {}
+    edges = []
+    for article, reference in pairs:
+        labels = article.label, reference.label
+        if labels[0] == labels[1] or "null" in (label.lower() for label in labels):
+            continue
+        ends = []
+        for node, label in zip((article, reference), labels):
+            index = ids.setdefault(label, len(ids))
+            if index >= graph.vcount():
+                nodes[index] = node
+            ends.append(index)
+        edges.append(tuple(ends))
+
+    labels = list(ids)
+    edges = list(dict.fromkeys(edges))
+    candidates = [edge for edge in edges if max(edge) < graph.vcount()]
+    known = graph.get_eids(pairs=candidates, error=False)
+    known = {edge for edge, eid in zip(candidates, known) if eid >= 0}
+    edges = [edge for edge in edges if edge not in known]
+
+    size = graph.vcount()
+    attributes = graph.vs.attributes()
+    graph.add_vertices(len(labels) - size)
+    new_vertices = graph.vs[size:]
+    new_vertices["name"] = new_vertices["label"] = labels[size:]
+    records = [nodes[index].to_dict() for index in range(size, len(labels))]
+    for key, values in _columns(records).items():
+        if key in attributes:
+            new_vertices[key] = values
+    for key in TREE_ATTRIBUTES:
+        if key in attributes:
+            new_vertices[key] = 0
+    graph.add_edges(edges)
+    return edges
+
+
+def load(
+    collection: Collection,
+    metadata: bool = True,
+    loops: str = LOOPS_COMPONENTS,
+    profile: Optional[Profile] = None,
+) -> Iterator[Graph]:
     """
     Takes in a collection of bibliographic records and gets out all the
     connected components of their citation graph.
 
+    The citation pairs are streamed once keeping only interned label ids and
+    the edge arrays, the article metadata is only read for the vertices that
+    survive the pruning.
+
     :param Collection collection: bibliographic collection
+    :param bool metadata: copy the article metadata onto the vertices, when
+        ``False`` the vertices only get their label and year, see `annotate`
+    :param str loops: how to break the citation cycles, see `LOOP_POLICIES`
+    :param Profile profile: gets the measurements of every stage
     :return: iterator over the connected components
     """
-    metadata = {}
-    pair_labels = []
-    for article, reference in collection.citation_pairs():
-        article_label = article.label
-        reference_label = reference.label
-        metadata[article_label] = article.to_dict()
-        metadata[reference_label] = reference.to_dict()
-        pair_labels.append((article_label, reference_label))
-
-    graph = Graph(directed=True)
-    for label, attrs in metadata.items():
-        graph.add_vertex(name=label, label=label, **attrs)
-
-    graph.add_edges(pair_labels)
-    graph = graph.simplify()
-    valid_vs = graph.vs.select(lambda v: v["label"].lower() != "null").indices
-    graph = graph.subgraph(valid_vs)
-    valid_vs = graph.vs.select(
-        lambda v: v.indegree() != 1 or v.outdegree() != 0
-    ).indices
-    graph = graph.subgraph(valid_vs)
-    graph = _break_loops(graph)
+    ids: Dict[str, int] = {}
+    nodes: List[Article] = []
+    citing = array("q")
+    cited = array("q")
+    with stage(profile, "parse"):
+        for article, reference in collection.citation_pairs():
+            for node, ends in ((article, citing), (reference, cited)):
+                index = ids.setdefault(node.label, len(ids))
+                if index == len(nodes):
+                    nodes.append(node)
+                else:
+                    nodes[index] = node
+                ends.append(index)
+
+    with stage(profile, "preprocess") as step:
+        size = len(ids)
+        sources = np.frombuffer(citing, dtype=np.int64)
+        targets = np.frombuffer(cited, dtype=np.int64)
+        valid = np.array([label.lower() != "null" for label in ids], dtype=bool)
+        keep = (sources != targets) & valid[sources] & valid[targets]
+        sources, targets = np.divmod(
+            np.unique(sources[keep] * size + targets[keep]), size
+        )
+        del citing, cited
+
+        indegree = np.bincount(targets, minlength=size)
+        outdegree = np.bincount(sources, minlength=size)
+        valid &= (indegree != 1) | (outdegree != 0)
+        keep = valid[sources] & valid[targets]
+        new_ids = np.cumsum(valid) - 1
+        edges = zip(new_ids[sources[keep]].tolist(), new_ids[targets[keep]].tolist())
+
+        survivors = np.flatnonzero(valid).tolist()
+        labels = list(ids)
+        labels = [labels[index] for index in survivors]
+        del ids
+        if metadata:
+            vertex_attrs = _columns(nodes[index].to_dict() for index in survivors)
+        else:
+            vertex_attrs = {"year": [nodes[index].year for index in survivors]}
+        del nodes
+        vertex_attrs.update(name=labels, label=labels)
+        graph = step.output = ig.Graph(
+            n=len(labels), edges=list(edges), directed=True, vertex_attrs=vertex_attrs
+        )
+    with stage(profile, "break_loops", graph) as step:
+        graph = step.output = _break_loops(graph, loops)
+    yield from _with_components(graph, profile)
+
+
+def _with_components(
+    graph: Graph, profile: Optional[Profile] = None
+) -> Iterator[Graph]:
+    """
+    Yields the graph and then its connected components with some citations,
+    see `_components`.
+    """
     yield graph
-    for subgraph in graph.decompose(MODE_WEAK, minelements=2):
-        if len(subgraph.vs.select(_indegree_gt=0, _outdegree_gt=0)) > 0:
-            yield subgraph
+    yield from _components(graph, profile)
+
+
+def _components(graph: Graph, profile: Optional[Profile] = None) -> Iterator[Graph]:
+    """
+    Yields the weakly connected components of a graph, largest first, that
+    have an article both citing and cited. Every component is built only when
+    it's asked for, out of a single membership vector, and a graph made of a
+    single component is yielded as is.
+    """
+    with stage(profile, "components", graph):
+        membership = np.asarray(graph.components(MODE_WEAK).membership, dtype=np.int64)
+        sizes = np.bincount(membership)
+        vcount = graph.vcount()
+        middle = (np.asarray(graph.indegree()) > 0) & (
+            np.asarray(graph.outdegree()) > 0
+        )
+        wanted = np.bincount(membership[middle], minlength=len(sizes)) > 0
+        # Ties keep the order of their first vertex, same as `Graph.decompose`
+        order = np.argsort(-sizes, kind="stable")
+        order = order[wanted[order]]
+        members = np.argsort(membership, kind="stable")
+        ends = np.cumsum(sizes)
+    for component in order.tolist():
+        if sizes[component] == vcount:
+            yield graph
+            continue
+        with stage(profile, "component", graph) as step:
+            vertices = members[ends[component] - sizes[component] : ends[component]]
+            subgraph = step.output = graph.induced_subgraph(vertices.tolist())
+        yield subgraph
 
 
-def giant(collection: Collection) -> Graph:
+def giant(
+    collection: Collection,
+    metadata: bool = True,
+    loops: str = LOOPS_COMPONENTS,
+    profile: Optional[Profile] = None,
+) -> Graph:
     """
     Takes in a collection of bibliographic records and gets out the giant pre
     processed connected component.
 
     :param Collection collection: bibliographic collection
-    :return: connected component graph
+    :param bool metadata: copy the article metadata onto the vertices
+    :param str loops: how to break the citation cycles, see `LOOP_POLICIES`
+    :param Profile profile: gets the measurements of every stage
+    :return: the largest connected component, or the whole graph if none of
+        the components has an article both citing and cited
+    """
+    return _largest(load(collection, metadata=metadata, loops=loops, profile=profile))
+
+
+def _largest(graphs: Iterable[Graph]) -> Optional[Graph]:
+    """
+    Picks the largest component out of the graphs yielded by `load`, which
+    come right after the whole graph, or the whole graph if there are none.
+    """
+    graphs = iter(graphs)
+    whole = next(graphs, None)
+    return next(graphs, whole)
+
+
+def annotate(graph: Graph, collection: Collection) -> Graph:
+    """
+    Copies the metadata of the articles in a collection onto the vertices of
+    a graph loaded with ``metadata=False``, usually a tree already cleared of
+    untagged nodes.
+
+    :param Graph graph: graph whose vertices are labeled after the articles
+    :param Collection collection: bibliographic collection the graph came from
+    :return: copy of the graph with the article metadata
+    """
+    graph = graph.copy()
+    wanted = {label: index for index, label in enumerate(graph.vs["label"])}
+    found: Dict[int, dict] = {}
+    for article in collection:
+        index = wanted.get(article.label)
+        if index is not None:
+            found[index] = article.to_dict()
+    for key, values in _columns(
+        found.get(index, {}) for index in range(graph.vcount())
+    ).items():
+        graph.vs[key] = values
+    return graph
+
+
+def _columns(records: Iterable[dict]) -> Dict[str, list]:
+    records = list(records)
+    keys = {key: None for record in records for key in record}
+    return {key: [record.get(key) for record in records] for key in keys}
+
+
+class _Propagator:
+    """
+    Sums values along the citation edges of a directed acyclic graph.
+
+    With ``MODE_OUT`` every vertex with references gets the sum of the values
+    of the articles it cites, with ``MODE_IN`` every cited vertex gets the sum
+    of the values of the articles citing it. Vertices without neighbors in
+    that direction keep their initial value.
+
+    The ``python`` engine walks the topological order vertex by vertex, the
+    ``numpy`` engine reads the edge list once and sums whole levels of the
+    graph at a time using 64 bit integers, or python integers from the level
+    where they overflow.
+
+    Values are counts going in and come out as set by ``numbers``: python
+    integers (``exact``), integers that raise `OverflowError` when they don't
+    fit in 64 bits (``int64``), floats (``float``) or their natural logarithm,
+    ``-inf`` for zero (``log``).
+
+    :param dict structure: the topological order and plans of the graph,
+        shared by the propagators along the same graph
+    :ivar remembered: what has been propagated, when set to a dict, so that
+        propagating the same values again is free
+    """
+
+    def __init__(
+        self,
+        graph: Graph,
+        engine: str = ENGINE_PYTHON,
+        numbers: str = NUMBERS_EXACT,
+        structure: Optional[Dict[str, Any]] = None,
+    ):
+        self.graph = graph
+        self.engine = engine
+        self.numbers = numbers
+        self.remembered: Optional[Dict[tuple, List]] = None
+        self._structure = {} if structure is None else structure
+
+    def propagate(
+        self, initial: Sequence, mode: str = MODE_OUT, stored: bool = False
+    ) -> List:
+        """
+        :param bool stored: the initial values are as stored in the vertex
+            attributes, see `_stored`, instead of counts
+        """
+        if self.remembered is None:
+            return self._propagate(initial, mode, stored)
+        key = (mode, stored, tuple(initial))
+        if key not in self.remembered:
+            self.remembered[key] = self._propagate(initial, mode, stored)
+        return list(self.remembered[key])
+
+    def _propagate(self, initial: Sequence, mode: str, stored: bool) -> List:
+        return self._sum(self._start(initial, stored), mode)
+
+    def _start(self, initial: Sequence, stored: bool) -> List:
+        if self.numbers == NUMBERS_LOG:
+            values = np.asarray(initial, dtype=np.float64)
+            with np.errstate(divide="ignore"):
+                if stored:
+                    return (values + np.log(-np.expm1(-values))).tolist()
+                return np.log(values).tolist()
+        if self.numbers == NUMBERS_FLOAT:
+            return [float(value) for value in initial]
+        return list(initial)
+
+    def _sum(self, values: List, mode: str) -> List:
+        if self.engine == ENGINE_NUMPY:
+            return self._propagate_numpy(values, mode)
+        return self._propagate_python(values, mode)
+
+    @property
+    def order(self) -> List[int]:
+        if "order" not in self._structure:
+            self._structure["order"] = self.graph.topological_sorting()
+        return self._structure["order"]
+
+    def vcount(self) -> int:
+        return self.graph.vcount()
+
+    def ecount(self) -> int:
+        return self.graph.ecount()
+
+    def _propagate_python(self, values: List, mode: str) -> List:
+        total = _log_sum if self.numbers == NUMBERS_LOG else sum
+        order = reversed(self.order) if mode == MODE_OUT else self.order
+        for index in order:
+            neighbors = self.graph.neighbors(index, mode=mode)
+            if neighbors:
+                values[index] = total(values[neighbor] for neighbor in neighbors)
+        _check_overflow(values, self.numbers)
+        return values
+
+    def _propagate_numpy(self, initial: List, mode: str) -> List:
+        values = _tag_array(initial)
+        add = np.logaddexp if self.numbers == NUMBERS_LOG else np.add
+        owners, feeders, group_starts, level_bounds = self._plan(mode)
+        group_owners = owners[group_starts]
+        ends = np.append(group_starts[1:], len(owners))
+        fan_in = int((ends - group_starts).max(initial=0))
+        for start, stop in zip(level_bounds[:-1], level_bounds[1:]):
+            if start == stop:
+                continue
+            first, last = group_starts[start], ends[stop - 1]
+            summed = values[feeders[first:last]]
+            offsets = group_starts[start:stop] - first
+            with np.errstate(over="ignore"):
+                sums = add.reduceat(summed, offsets)
+            # Sums of 64 bit integers wrap around silently, the levels that
+            # might overflow get summed again with python integers
+            if values.dtype == np.int64 and int(summed.max()) * fan_in > INT64_MAX:
+                sums = np.add.reduceat(summed.astype(object), offsets)
+                if max(sums) > INT64_MAX:
+                    _check_overflow(sums, self.numbers)
+                    values = values.astype(object)
+            values[group_owners[start:stop]] = sums
+        values = values.tolist()
+        _check_overflow(values, self.numbers)
+        return values
+
+    def _plan(self, mode: str):
+        if mode in self._structure:
+            return self._structure[mode]
+        if "edges" not in self._structure:
+            self._structure["edges"] = _edge_array(self.graph)
+        edges = self._structure["edges"]
+        sources, targets = edges[:, 0], edges[:, 1]
+        owners, feeders = (sources, targets) if mode == MODE_OUT else (targets, sources)
+        levels = _levels(self.vcount(), owners, feeders)
+        order = np.lexsort((owners, levels[owners]))
+        owners, feeders = owners[order], feeders[order]
+        edge_levels = levels[owners]
+        keep = edge_levels > 0
+        owners, feeders, edge_levels = owners[keep], feeders[keep], edge_levels[keep]
+        group_starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+        group_levels = edge_levels[group_starts]
+        top = group_levels[-1] if len(group_levels) else 0
+        level_bounds = np.searchsorted(group_levels, np.arange(1, top + 2))
+        self._structure[mode] = owners, feeders, group_starts, level_bounds
+        return self._structure[mode]
+
+
+def _log_sum(logs: Iterable[float]) -> float:
+    """
+    Logarithm of the sum of some numbers out of their logarithms.
+    """
+    logs = list(logs)
+    top = max(logs)
+    if top == -math.inf:
+        return top
+    return top + math.log(sum(math.exp(value - top) for value in logs))
+
+
+def _check_overflow(values: Sequence, numbers: str) -> None:
+    """
+    Raises `OverflowError` when ``int64`` counts don't fit in 64 bits or
+    ``float`` counts got to infinity.
+    """
+    if numbers == NUMBERS_INT64 and max(values, default=0) > INT64_MAX:
+        raise OverflowError(
+            "Some counts don't fit in 64 bits, try the float or log numbers"
+        )
+    if numbers == NUMBERS_FLOAT and max(values, default=0) == math.inf:
+        raise OverflowError("Some counts don't fit in 64 bit floats, try log numbers")
+
+
+def _stored(values: List, numbers: str) -> List:
+    """
+    Counts, as they come out of `_Propagator.propagate`, as they are stored
+    in the vertex attributes: ``log`` numbers are kept as ``ln(1 + count)`` so
+    that zero stays zero and the order stays the same.
+
+    They are also rounded to `LOG_DIGITS` significant digits, as summing in a
+    different order changes the last few digits of large logarithms, so that
+    the engines agree on the ties. Logarithms that close to a rounding
+    boundary can still come out a digit apart.
+    """
+    if numbers != NUMBERS_LOG:
+        return values
+    stored = np.logaddexp(0, values)
+    rounded = (stored > 0) & np.isfinite(stored)
+    scale = 10.0 ** (LOG_DIGITS - 1 - np.floor(np.log10(stored[rounded])))
+    stored[rounded] = np.round(stored[rounded] * scale) / scale
+    return stored.tolist()
+
+
+class _SampledPropagator(_Propagator):
+    """
+    Propagates along a sample of the citations made by the articles nobody
+    cites, which are most of the citations of a large collection.
+
+    An article like that with ``m`` references keeps each one with probability
+    ``1 / (1 + error ** 2 * m)`` and whatever goes through the ones kept gets
+    scaled back by the inverse of that probability. Paths only start at these
+    articles, never go through them, so the propagated values are unbiased
+    estimates of the exact ones, and when the references of an article carry
+    alike values ``error`` is the relative standard error of its estimate.
+    Integer estimates are summed as floats and rounded, or as logarithms when
+    they get past the range of floats.
+
+    The sample is kept as an edge array and the estimates, being floats, are
+    always summed a level at a time like the ``numpy`` engine does, so that
+    sampling never costs more than it saves.
+
+    :param dict structure: the topological order and plans of the whole graph,
+        its edges get sampled when they're known
+    """
+
+    def __init__(
+        self,
+        graph: Graph,
+        numbers: str,
+        error: float,
+        seed: int = 0,
+        structure: Optional[Dict[str, Any]] = None,
+    ):
+        indegree = np.array(graph.indegree())
+        outdegree = np.array(graph.outdegree())
+        self.sources = (indegree == 0) & (outdegree > 0)
+        probability = 1 / (1 + error**2 * outdegree)
+        self.weights = np.where(self.sources, 1 / probability, 1.0)
+
+        if structure is not None and "edges" in structure:
+            edges = structure["edges"]
+        else:
+            # Quicker to read than the edge list, and in an order as good
+            cited = np.fromiter(
+                chain.from_iterable(graph.get_adjlist(mode="out")),
+                dtype=np.int64,
+                count=graph.ecount(),
+            )
+            edges = np.column_stack(
+                (np.repeat(np.arange(graph.vcount()), outdegree), cited)
+            )
+        citing = edges[:, 0]
+        random = np.random.default_rng(seed).random(len(edges))
+        kept = ~self.sources[citing] | (random < probability[citing])
+        self.size = graph.vcount()
+        super().__init__(None, ENGINE_NUMPY, numbers, {"edges": edges[kept]})
+
+    def vcount(self) -> int:
+        return self.size
+
+    def ecount(self) -> int:
+        return len(self._structure["edges"])
+
+    def _propagate(self, initial: Sequence, mode: str, stored: bool) -> List:
+        if self.numbers in (NUMBERS_FLOAT, NUMBERS_LOG):
+            return self._estimate(initial, mode, stored)
+        try:
+            values = self._with(NUMBERS_FLOAT)._estimate(initial, mode, False)
+            counts = [int(value) for value in np.rint(values).tolist()]
+        except OverflowError:
+            logs = self._with(NUMBERS_LOG)._estimate(initial, mode, False)
+            counts = [int(Decimal(value).exp().to_integral_value()) for value in logs]
+        _check_overflow(counts, self.numbers)
+        return counts
+
+    def _with(self, numbers: str) -> "_SampledPropagator":
+        # Shares the sample and the structure, only the numbers change
+        propagator = copy(self)
+        propagator.numbers = numbers
+        return propagator
+
+    def _estimate(self, initial: Sequence, mode: str, stored: bool) -> List:
+        start = self._start(initial, stored)
+        seeds = np.asarray(start, dtype=np.float64)
+        log = self.numbers == NUMBERS_LOG
+        scale = np.log(self.weights) if log else self.weights
+        if mode == MODE_IN:
+            start = (seeds + scale if log else seeds * scale).tolist()
+        values = np.asarray(self._sum(start, mode), dtype=np.float64)
+        if mode == MODE_IN:
+            values[self.sources] = seeds[self.sources]
+        elif log:
+            values[self.sources] += scale[self.sources]
+        else:
+            values[self.sources] *= scale[self.sources]
+        values = values.tolist()
+        _check_overflow(values, self.numbers)
+        return values
+
+
+class _Propagators:
+    """
+    Propagators along a graph for the configurations growing trees out of it,
+    one per engine, numbers and sample, that remember what they propagate.
+    The ones along the whole graph share its topological order and plans.
     """
-    return next(load(collection), None)
 
+    def __init__(self, graph: Graph):
+        self.graph = graph
+        self._structure: Dict[str, Any] = {}
+        self._propagators: Dict[tuple, _Propagator] = {}
 
-def _sorted_nodes(graph: Graph, by: str, reverse: bool = True) -> List[int]:
-    indices = graph.vs.indices
-    attribtes = graph.vs[indices][by]
-    return [
-        index
-        for index, _ in sorted(
-            zip(indices, attribtes), key=lambda item: item[1], reverse=reverse,
+    def get(self, sapper: Sap, profile: Optional[Profile] = None) -> _Propagator:
+        """
+        :param Profile profile: gets the time spent sampling the citations,
+            as the ``sample`` stage, for approximate trees
+        """
+        sampled = sapper.approximate is not None
+        key = (
+            sapper.engine,
+            sapper.numbers,
+            sapper.approximate,
+            sapper.seed if sampled else None,
         )
-    ]
+        if key not in self._propagators:
+            if sampled:
+                with stage(profile, "sample", self.graph) as step:
+                    propagator = sapper._propagator(self.graph, self._structure)
+                    # Stands in for the sample, which may not be a graph yet
+                    step.output = propagator
+            else:
+                propagator = sapper._propagator(self.graph, self._structure)
+            propagator.remembered = {}
+            self._propagators[key] = propagator
+        return self._propagators[key]
+
+
+def _reachable(graph: Graph, seeds: Iterable[int], mode: str) -> List[int]:
+    """
+    Every vertex reachable from the seeds following the edges in ``mode``
+    direction, seeds included.
+    """
+    seen = set(seeds)
+    stack = list(seen)
+    while stack:
+        for neighbor in graph.neighbors(stack.pop(), mode=mode):
+            if neighbor not in seen:
+                seen.add(neighbor)
+                stack.append(neighbor)
+    return list(seen)
+
+
+def _repropagate(
+    graph: Graph, values: list, initial: Sequence, vertices: List[int], mode: str
+):
+    """
+    Propagates again, in place, the values of some vertices like
+    `_Propagator.propagate` does, reading the current values of their
+    neighbors outside of the set.
+    """
+    inside = set(vertices)
+    opposite = MODE_IN if mode == MODE_OUT else MODE_OUT
+    pending = {
+        vertex: sum(1 for n in graph.neighbors(vertex, mode=mode) if n in inside)
+        for vertex in vertices
+    }
+    ready = [vertex for vertex, count in pending.items() if count == 0]
+    while ready:
+        vertex = ready.pop()
+        neighbors = graph.neighbors(vertex, mode=mode)
+        if neighbors:
+            values[vertex] = sum(values[neighbor] for neighbor in neighbors)
+        else:
+            values[vertex] = initial[vertex]
+        for owner in graph.neighbors(vertex, mode=opposite):
+            if owner in inside:
+                pending[owner] -= 1
+                if pending[owner] == 0:
+                    ready.append(owner)
+
+
+def _edge_array(graph: Graph) -> np.ndarray:
+    """
+    The edges of the graph as an ``(ecount, 2)`` array of source and target.
+    """
+    return np.fromiter(
+        chain.from_iterable(graph.get_edgelist()),
+        dtype=np.int64,
+        count=2 * graph.ecount(),
+    ).reshape(-1, 2)
+
+
+def _levels(size: int, owners: np.ndarray, feeders: np.ndarray) -> np.ndarray:
+    """
+    Longest distance from every owner to a vertex without feeders, ``-1`` for
+    the vertices that sit on or behind a cycle.
+    """
+    levels = np.full(size, -1, dtype=np.int64)
+    pending = np.bincount(owners, minlength=size)
+    by_feeder = np.argsort(feeders, kind="stable")
+    pointers = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(feeders, minlength=size), out=pointers[1:])
+    frontier = np.flatnonzero(pending == 0)
+    level = 0
+    while len(frontier):
+        levels[frontier] = level
+        counts = pointers[frontier + 1] - pointers[frontier]
+        offsets = np.repeat(pointers[frontier] - np.cumsum(counts) + counts, counts)
+        touched = owners[by_feeder[offsets + np.arange(counts.sum())]]
+        np.subtract.at(pending, touched, 1)
+        frontier = np.unique(touched[pending[touched] == 0])
+        level += 1
+    return levels
+
+
+def top_k(values: Sequence, k: Optional[int] = None) -> List[int]:
+    """
+    Gets the indices of the ``k`` largest values, largest first and ties in
+    index order, just like a stable reverse sort would, without sorting all
+    the values.
+
+    :param values: numbers to rank
+    :param int k: how many indices to get, ``None`` for all of them
+    :return: list of indices
+    """
+    size = len(values)
+    if k is None or k >= size:
+        return sorted(range(size), key=values.__getitem__, reverse=True)
+    if k <= 0:
+        return []
+    array = np.asarray(values)
+    if array.dtype.kind not in "iuf":
+        return heapq.nlargest(k, range(size), key=values.__getitem__)
+    kth = np.partition(array, size - k)[size - k]
+    above = np.flatnonzero(array > kth)
+    ties = np.flatnonzero(array == kth)[: k - len(above)]
+    chosen = np.concatenate([above, ties])
+    return chosen[np.lexsort((chosen, -array[chosen]))].tolist()
+
+
+def _keep_top(values: List, k: int) -> List:
+    kept = [0] * len(values)
+    for index in top_k(values, k):
+        kept[index] = values[index]
+    return kept
 
 
-def _break_loops(graph: Graph) -> Graph:
-    loops = graph.decompose(MODE_STRONG, minelements=2)
+def _break_loops(graph: Graph, policy: str = LOOPS_COMPONENTS) -> Graph:
+    """
+    Gets a copy of the graph without cycles.
+
+    With ``LOOPS_COMPONENTS`` every citation inside a strongly connected
+    component goes away, with ``LOOPS_FEEDBACK`` (a fast heuristic) or
+    ``LOOPS_MINIMAL`` (exact, but slow on big cycles) only the citations of a
+    feedback arc set do.
+    """
+    if policy == LOOPS_COMPONENTS:
+        membership = np.array(graph.components(mode=MODE_STRONG).membership)
+        edges = membership[_edge_array(graph)]
+        loops = np.flatnonzero(edges[:, 0] == edges[:, 1]).tolist()
+    elif policy in LOOP_POLICIES:
+        method = "eades" if policy == LOOPS_FEEDBACK else "ip"
+        loops = graph.feedback_arc_set(None, method)
+    else:
+        raise ValueError(
+            f"Unknown loop policy {policy!r}, expected one of {LOOP_POLICIES}"
+        )
     _graph = graph.copy()
-    for loop in loops:
-        edges = [(e.source_vertex["label"], e.target_vertex["label"]) for e in loop.es]
-        _graph.delete_edges(edges)
-    _graph.simplify()
+    _graph.delete_edges(loops)
+    if not _graph.is_simple():
+        _graph.simplify()
     return _graph
+
+
+def __getattr__(name: str):
+    if name in ("Article", "Collection"):
+        return getattr(wostools, name)
+    if name == "Graph":
+        return ig.Graph
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
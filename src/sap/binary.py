@@ -0,0 +1,220 @@
+"""
+Binary format for citation graphs that can be memory mapped.
+
+A file starts with ``SAPGRAPH``, the format version and the length of a JSON
+header describing the arrays that follow: the edges as an ``(ecount, 2)``
+array and every vertex attribute as one or more columns. Every array starts at
+a multiple of 64 bytes so it can be used straight out of a memory map.
+
+Only vertex attributes are kept, which is all `load` and `Sap.tree` use.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import struct
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+    Union,
+)
+
+from sap import _edge_array, _with_components, ig, np
+from sap.profiling import Profile, stage
+
+if TYPE_CHECKING:
+    from igraph import Graph
+
+MAGIC = b"SAPGRAPH"
+VERSION = 1
+ALIGNMENT = 64
+PREAMBLE = struct.Struct("<IQ")
+
+KIND_INT = "int"
+KIND_FLOAT = "float"
+KIND_BOOL = "bool"
+KIND_STR = "str"
+KIND_JSON = "json"
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _strings(values: List[Optional[str]]) -> Dict[str, np.ndarray]:
+    encoded = [b"" if value is None else value.encode() for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return {
+        "offsets": offsets,
+        "data": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        "missing": np.array([value is None for value in values], dtype=bool),
+    }
+
+
+def _encode(values: list) -> Tuple[str, Dict[str, np.ndarray]]:
+    """
+    Picks the columns for a vertex attribute, ``None`` values are tracked in a
+    ``missing`` column and anything that isn't a number, a boolean or a string
+    is stored as JSON.
+    """
+    present = [value for value in values if value is not None]
+    missing = np.array([value is None for value in values], dtype=bool)
+    if present and all(isinstance(value, bool) for value in present):
+        column = np.array([bool(value) for value in values], dtype=bool)
+        return KIND_BOOL, {"values": column, "missing": missing}
+    if all(isinstance(value, int) and not isinstance(value, bool) for value in present):
+        try:
+            column = np.array([value or 0 for value in values], dtype=np.int64)
+            return KIND_INT, {"values": column, "missing": missing}
+        except OverflowError:
+            pass
+    elif all(
+        isinstance(value, (int, float)) and not isinstance(value, bool)
+        for value in present
+    ):
+        column = np.array([value or 0 for value in values], dtype=np.float64)
+        return KIND_FLOAT, {"values": column, "missing": missing}
+    elif all(isinstance(value, str) for value in present):
+        return KIND_STR, _strings(values)
+    return KIND_JSON, _strings([json.dumps(value, default=str) for value in values])
+
+
+def _decode(kind: str, columns: Dict[str, np.ndarray]) -> list:
+    missing = columns["missing"].tolist()
+    if kind in (KIND_INT, KIND_FLOAT, KIND_BOOL):
+        values = columns["values"].tolist()
+        return [None if gone else value for value, gone in zip(values, missing)]
+    data = columns["data"].tobytes()
+    offsets = columns["offsets"].tolist()
+    values = [
+        None if gone else data[start:end].decode()
+        for start, end, gone in zip(offsets, offsets[1:], missing)
+    ]
+    if kind == KIND_JSON:
+        return [json.loads(value) for value in values]
+    return values
+
+
+def write(graph: Graph, output: BinaryIO):
+    """
+    Writes a graph with its vertex attributes to a binary file.
+    """
+    edges = _edge_array(graph)
+    columns = [
+        ("edges", edges.astype(np.int32 if graph.vcount() < 2**31 else np.int64))
+    ]
+    attributes = {}
+    for name in graph.vs.attributes():
+        kind, encoded = _encode(graph.vs[name])
+        attributes[name] = kind
+        columns.extend(
+            (f"vertex/{name}/{key}", array) for key, array in encoded.items()
+        )
+
+    arrays = {}
+    offset = 0
+    for key, array in columns:
+        arrays[key] = {
+            "offset": offset,
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+        }
+        offset = _align(offset + array.nbytes)
+    header = json.dumps(
+        {
+            "vertices": graph.vcount(),
+            "edges": graph.ecount(),
+            "directed": graph.is_directed(),
+            "attributes": attributes,
+            "arrays": arrays,
+        }
+    ).encode()
+
+    written = len(MAGIC) + PREAMBLE.size + len(header)
+    output.write(MAGIC + PREAMBLE.pack(VERSION, len(header)) + header)
+    output.write(bytes(_align(written) - written))
+    for key, array in columns:
+        array = np.ascontiguousarray(array)
+        output.write(array.data)
+        output.write(bytes(_align(array.nbytes) - array.nbytes))
+
+
+def read_arrays(path: str) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """
+    Memory maps the arrays of a binary graph file without building a graph.
+
+    :return: the header of the file and its arrays by name, ``edges`` and
+        ``vertex/<attribute>/<column>``
+    """
+    with open(path, "rb") as source:
+        start = source.read(len(MAGIC) + PREAMBLE.size)
+        if start[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a binary graph file")
+        version, length = PREAMBLE.unpack(start[len(MAGIC) :])
+        if version != VERSION:
+            raise ValueError(f"{path} has version {version}, expected {VERSION}")
+        header = json.loads(source.read(length))
+
+    base = _align(len(MAGIC) + PREAMBLE.size + length)
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for key, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        shape = tuple(spec["shape"])
+        size = int(np.prod(shape)) * dtype.itemsize
+        start = base + spec["offset"]
+        arrays[key] = buffer[start : start + size].view(dtype).reshape(shape)
+    return header, arrays
+
+
+def read(path: str, profile: Optional[Profile] = None) -> Graph:
+    """
+    Reads a graph out of a binary file, ready for `Sap.tree`.
+    """
+    with stage(profile, "read") as step:
+        header, arrays = read_arrays(path)
+        vertex_attrs = {}
+        for name, kind in header["attributes"].items():
+            prefix = f"vertex/{name}/"
+            vertex_attrs[name] = _decode(
+                kind,
+                {
+                    key[len(prefix) :]: array
+                    for key, array in arrays.items()
+                    if key.startswith(prefix)
+                },
+            )
+        graph = step.output = ig.Graph(
+            n=header["vertices"],
+            edges=arrays["edges"].tolist(),
+            directed=header["directed"],
+            vertex_attrs=vertex_attrs,
+        )
+    return graph
+
+
+def load(path: str, profile: Optional[Profile] = None) -> Iterator[Graph]:
+    """
+    Like `sap.load` for a binary file, the whole graph comes first and then
+    its connected components.
+    """
+    yield from _with_components(read(path, profile), profile)
+
+
+def is_graph_file(source: Union[str, TextIO, BinaryIO]) -> bool:
+    """
+    Tells if a path, or the file behind a file object, is a binary graph file.
+    """
+    path = getattr(source, "name", source)
+    if not isinstance(path, str) or not os.path.isfile(path):
+        return False
+    with open(path, "rb") as candidate:
+        return candidate.read(len(MAGIC)) == MAGIC
@@ -0,0 +1,143 @@
+"""On disk cache of preprocessed citation graphs."""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional, TextIO
+
+from sap import __version__, _with_components
+from sap.profiling import Profile, stage
+
+if TYPE_CHECKING:
+    from igraph import Graph
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+CACHE_FORMAT = "3"
+SUFFIX = ".pickle"
+
+
+def default_directory() -> str:
+    """
+    Directory used for the cache when none is given, ``$SAP_CACHE_DIR`` or
+    ``sap`` inside the user cache directory.
+    """
+    directory = os.environ.get("SAP_CACHE_DIR")
+    if directory:
+        return directory
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "sap")
+
+
+class GraphCache:
+    """
+    Stores the whole graph that `load` gets out of a set of sources, keyed by
+    the content of the sources, so that they don't need to be parsed again.
+    Its components are built again, as they're asked for, when it's read.
+
+    :param str directory: where to keep the cached graphs
+    :param int max_size: the least recently used entries get removed once the
+        cache grows past this many bytes
+    """
+
+    def __init__(
+        self, directory: Optional[str] = None, max_size: int = DEFAULT_MAX_SIZE
+    ):
+        self.directory = directory or default_directory()
+        self.max_size = max_size
+
+    def key(self, sources: Iterable[TextIO], *extra: str) -> str:
+        """
+        Hashes the content of the sources (in order) together with any extra
+        piece of information that changes the resulting graphs.
+        """
+        digest = hashlib.sha256(f"{CACHE_FORMAT}:{__version__}".encode())
+        for piece in extra:
+            digest.update(f"\0{piece}".encode())
+        for source in sources:
+            source.seek(0)
+            digest.update(b"\0")
+            for chunk in iter(lambda: source.read(1024 * 1024), ""):
+                digest.update(chunk.encode())
+            source.seek(0)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Graph]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as entry:
+                graph = pickle.load(entry)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning(f"Ignoring unreadable cache entry {path}", exc_info=True)
+            return None
+        os.utime(path)
+        logger.info(f"Loaded a graph of {graph.vcount()} vertices from {path}")
+        return graph
+
+    def put(self, key: str, graph: Graph):
+        os.makedirs(self.directory, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as entry:
+                pickle.dump(graph, entry, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self._path(key))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        self.evict()
+
+    def fetch(
+        self,
+        sources: Iterable[TextIO],
+        compute: Callable[[], Iterable[Graph]],
+        *extra: str,
+        profile: Optional[Profile] = None,
+    ) -> Iterator[Graph]:
+        """
+        Gets the whole graph for the sources out of the cache or computes and
+        stores it, see `key` for the extra pieces of information, and yields
+        it followed by its components, as `load` does.
+
+        :param compute: gets the graphs of the sources, the whole graph first,
+            only the whole graph is ever asked for
+        :param Profile profile: gets the time spent reading and writing the
+            cache, as the ``cache`` stage
+        """
+        with stage(profile, "cache"):
+            key = self.key(sources, *extra)
+            graph = self.get(key)
+        if graph is None:
+            graph = next(iter(compute()))
+            with stage(profile, "cache"):
+                self.put(key, graph)
+        return _with_components(graph, profile)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in its
+        maximum size.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            logger.info(f"Evicting {name} from the cache")
+            os.unlink(os.path.join(self.directory, name))
+            total -= size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}{SUFFIX}")
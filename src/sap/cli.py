@@ -1,9 +1,38 @@
 """Console script for python_sap."""
+import concurrent.futures
+import csv
+import glob
+import json
 import logging
+import math
+import os
+import shlex
+import time
+from contextlib import ExitStack
+from copy import copy
+from itertools import chain
+from typing import List
 
 import click
 
-from sap import Collection, Sap, giant, load
+from sap import (
+    ENGINE_PYTHON,
+    ENGINES,
+    LOOP_POLICIES,
+    LOOPS_COMPONENTS,
+    NUMBER_POLICIES,
+    NUMBERS_EXACT,
+    NUMBERS_LOG,
+    SWEEP_PARAMETERS,
+    Sap,
+    _largest,
+    load,
+    top_k,
+    trees_many,
+)
+from sap import binary, writers
+from sap.cache import DEFAULT_MAX_SIZE, GraphCache
+from sap.profiling import Profile, stage
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +46,7 @@ logger = logging.getLogger(__name__)
 @click.option(
     "--max-leaf-age",
     "-a",
-    help="Maximum age of a leaf (relative to the newest article)",
+    help="Maximum age of a leaf (relative to the newest leaf)",
     type=int,
     default=None,
 )
@@ -36,9 +65,97 @@ logger = logging.getLogger(__name__)
     is_flag=True,
     default=False,
 )
+@click.option(
+    "--engine",
+    "-e",
+    help="Engine used to propagate the sap along the graph",
+    type=click.Choice(ENGINES),
+    default=ENGINE_PYTHON,
+    show_default=True,
+)
+@click.option(
+    "--numbers",
+    help="How to count paths: exact integers, 64 bit integers that fail on "
+    "overflow, floats or logarithms",
+    type=click.Choice(NUMBER_POLICIES),
+    default=NUMBERS_EXACT,
+    show_default=True,
+)
+@click.option(
+    "--approximate",
+    "-x",
+    help="Estimate the connections out of a sample of the citations, with this "
+    "relative error (e.g. 0.1), instead of counting them exactly",
+    type=float,
+    default=None,
+)
+@click.option(
+    "--loops",
+    help="How to break citation cycles: drop every citation inside a cycle, or "
+    "just enough of them (fast heuristic or exact minimum)",
+    type=click.Choice(LOOP_POLICIES),
+    default=LOOPS_COMPONENTS,
+    show_default=True,
+)
+@click.option(
+    "--cache-dir",
+    help="Where to cache the parsed collections [default: ~/.cache/sap]",
+    type=click.Path(file_okay=False),
+    envvar="SAP_CACHE_DIR",
+    default=None,
+)
+@click.option(
+    "--cache-size",
+    help="Max size of the cache in megabytes",
+    type=int,
+    default=DEFAULT_MAX_SIZE // (1024 * 1024),
+    show_default=True,
+)
+@click.option(
+    "--no-cache",
+    help="Parse the sources again instead of using the cache",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--jobs",
+    "-j",
+    help="Number of processes used to parse the sources and grow the trees of "
+    "the components",
+    type=int,
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--profile",
+    help="Show how long every stage took once the command is done",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--profile-json",
+    help="Write the time every stage took to this file as JSON",
+    type=click.File("w"),
+    default=None,
+)
 @click.option("--verbose", "-v", count=True, help="Show some debug information")
 @click.pass_context
-def main(ctx, whole_graph, verbose, **kwargs):
+def main(
+    ctx,
+    whole_graph,
+    engine,
+    numbers,
+    approximate,
+    loops,
+    cache_dir,
+    cache_size,
+    no_cache,
+    jobs,
+    profile,
+    profile_json,
+    verbose,
+    **kwargs,
+):
     """
     A little cli for sap.
 
@@ -47,12 +164,23 @@ def main(ctx, whole_graph, verbose, **kwargs):
     ctx.ensure_object(dict)
     ctx.obj["sapper"] = Sap(
         default_clear_graph=not whole_graph,
+        engine=engine,
+        numbers=numbers,
+        approximate=approximate,
         **{
             key: value if value > 0 else None
             for key, value in kwargs.items()
             if value is not None
         },
     )
+    ctx.obj["jobs"] = jobs
+    ctx.obj["loops"] = loops
+    ctx.obj["cache"] = (
+        None if no_cache else GraphCache(cache_dir, cache_size * 1024 * 1024)
+    )
+    ctx.obj["profile"] = Profile() if profile or profile_json else None
+    if ctx.obj["profile"] is not None:
+        ctx.call_on_close(lambda: _report(ctx.obj["profile"], profile, profile_json))
     if verbose == 1:
         logging.basicConfig(level=logging.ERROR)
     if verbose == 2:
@@ -64,35 +192,215 @@ def main(ctx, whole_graph, verbose, **kwargs):
 @main.command()
 @click.argument("sources", type=click.File("r"), nargs=-1)
 @click.option("--output", "-o", type=click.File("w"), default="-")
+@click.option(
+    "--format",
+    "-f",
+    "_format",
+    help="Format of the output, binary files can be read back by every command",
+    type=click.Choice([*writers.FORMATS, "binary"]),
+    default=writers.FORMAT_GRAPHML,
+    show_default=True,
+)
+@click.option(
+    "--tagged-only",
+    help="Write only the roots, trunk and leaves, useful with --whole-graph",
+    is_flag=True,
+    default=False,
+)
 @click.pass_context
-def export(ctx, sources, output):
+def export(ctx, sources, output, _format, tagged_only):
     """
-    Creates a tree from a set of files and stores it in graphml format.
+    Creates the tree of the largest component of a set of files and stores it
+    in graphml format, or any other --format.
     """
-    sapper = ctx.obj["sapper"]
-    graph = giant(Collection(*sources))
-    graph = sapper.tree(graph)
-    graph.write(output, format="graphml")
+    _export(ctx.obj, sources, output, _format, tagged_only)
+
+
+def _export(obj, sources, output, _format, tagged_only=False):
+    sapper = obj["sapper"]
+    profile = obj["profile"]
+    graph = _largest(_graphs(obj, sources))
+    graph = sapper.tree(graph, profile=profile)
+    with stage(profile, "write", graph):
+        if _format == "binary":
+            if tagged_only:
+                graph = sapper.clear(graph)
+            binary.write(graph, getattr(output, "buffer", output))
+        else:
+            writers.write(graph, output, _format, tagged_only=tagged_only)
+
+
+@main.command()
+@click.argument("manifest", type=click.File("r"))
+@click.option(
+    "--report",
+    help="Write the outcome of every collection to this file as JSON Lines",
+    type=click.File("w"),
+    default=None,
+)
+@click.pass_context
+def batch(ctx, manifest, report):
+    """
+    Exports the trees of many collections listed in a manifest, using --jobs
+    processes, and reports how long each one took and which ones failed.
+
+    Every line of the manifest has the sources of a collection (files,
+    directories or globs separated by commas), the output path and optionally
+    some parameters, e.g.:
+
+        topics/graphene/ trees/graphene.jsonl max_roots=10 max_leaf_age=-1
+
+    The format comes from the output extension (.graphml, .csv, .jsonl or
+    .sapg for binary) unless given as format=..., paths are relative to the
+    manifest and lines starting with # are skipped.
+    """
+    entries = _manifest(manifest)
+    obj = {key: ctx.obj[key] for key in ("sapper", "cache", "loops")}
+    jobs = ctx.obj["jobs"]
+    if jobs <= 1:
+        results = (_batch_entry(obj, entry) for entry in entries)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(jobs)
+        ctx.call_on_close(executor.shutdown)
+        futures = {
+            executor.submit(_batch_entry, obj, entry): entry for entry in entries
+        }
+        results = (
+            _batch_result(futures[future], future)
+            for future in concurrent.futures.as_completed(futures)
+        )
+
+    failed = 0
+    for result in results:
+        measured = result.pop("profile", None)
+        if ctx.obj["profile"] is not None and measured is not None:
+            ctx.obj["profile"].extend(measured)
+        failed += result["status"] != "ok"
+        click.echo(
+            f"{result['status']:<8}{result['seconds']:>9.2f}s  {result['output']}"
+            + (f"  {result['error']}" if result.get("error") else "")
+        )
+        if report is not None:
+            report.write(json.dumps(result) + "\n")
+    click.echo(f"{len(entries) - failed} done, {failed} failed", err=True)
+    if failed:
+        ctx.exit(1)
 
 
 @main.command()
 @click.argument("sources", type=click.File("r"), nargs=-1)
+@click.option(
+    "--grid",
+    "-g",
+    multiple=True,
+    help="Values to try for a parameter, like max_roots=10,20,-1",
+)
 @click.option("--output", "-o", type=click.File("w"), default="-")
 @click.pass_context
-def describe(ctx, sources, output):
+def sweep(ctx, sources, grid, output):
     """
-    Describe every graph in a given bibliography collection.
+    Grows the biggest tree of a bibliography collection with every combination
+    of the given parameters and writes the roots, trunk and leaves of each one
+    as tab separated values.
     """
-    sapper = ctx.obj["sapper"]
-    for graph in load(Collection(*sources)):
+    parameters = {}
+    for entry in grid:
+        name, _, values = entry.partition("=")
+        name = name.strip().replace("-", "_")
+        if name not in SWEEP_PARAMETERS or not values:
+            raise click.BadParameter(
+                f"{entry!r}, expected name=value,... with a name in {SWEEP_PARAMETERS}",
+                param_hint="--grid",
+            )
         try:
-            graph = sapper.tree(graph)
-            click.echo(graph.summary() + "\n")
-        except TypeError:
-            logger.exception(
-                f"There was an error processing the graph\n{graph.summary()}"
+            parameters[name] = [
+                number if number > 0 else None
+                for number in (int(value) for value in values.split(","))
+            ]
+        except ValueError:
+            raise click.BadParameter(
+                f"{entry!r} has a non integer value", param_hint="--grid"
             )
 
+    graph = _largest(_graphs(ctx.obj, sources))
+    writer = csv.writer(output, delimiter="\t", lineterminator="\n")
+    writer.writerow([*SWEEP_PARAMETERS, "roots", "trunk", "leaves"])
+    for row in ctx.obj["sapper"].sweep(graph, parameters):
+        writer.writerow(
+            [
+                *("" if row[name] is None else row[name] for name in SWEEP_PARAMETERS),
+                *("; ".join(row[part]) for part in ("roots", "trunk", "leaves")),
+            ]
+        )
+
+
+@main.command()
+@click.argument("sources", type=click.File("r"), nargs=-1)
+@click.pass_context
+def overlap(ctx, sources):
+    """
+    Grows the biggest tree of a bibliography collection exactly and with
+    --approximate, and tells how many roots, trunk and leaves they share.
+    """
+    sapper = ctx.obj["sapper"]
+    if sapper.approximate is None:
+        raise click.UsageError("Set an error budget with --approximate")
+    graph = _largest(_graphs(ctx.obj, sources))
+    if graph is None:
+        raise click.UsageError("There are no articles in the sources")
+    report = sapper.overlap(graph)
+    click.echo(f"{'part':<8}{'exact':>8}{'approx':>8}{'shared':>8}")
+    for part in ("root", "trunk", "leaf"):
+        counts = report[part]
+        click.echo(
+            f"{part:<8}{counts['exact']:>8}{counts['approximate']:>8}"
+            f"{counts['shared']:>8}"
+        )
+    click.echo(
+        f"Sampled {report['sampled_edges']} of {report['edges']} citations, "
+        f"{report['approximate_seconds']:.3f}s instead of "
+        f"{report['exact_seconds']:.3f}s"
+    )
+
+
+@main.command()
+@click.argument("sources", type=click.File("r"), nargs=-1)
+@click.option("--output", "-o", type=click.File("w"), default="-")
+@click.option(
+    "--config",
+    "-C",
+    "configs",
+    multiple=True,
+    help="A named configuration to grow the trees with, like "
+    "narrow:max_roots=10,max_leaves=20, the rest of the parameters are taken "
+    "from the options",
+)
+@click.pass_context
+def describe(ctx, sources, output, configs):
+    """
+    Describe every graph in a given bibliography collection, or the trees of
+    every --config at once, which share the work they have in common.
+    """
+    sapper = ctx.obj["sapper"]
+    graphs = _graphs(ctx.obj, sources)
+    if not configs:
+        trees = sapper.tree_many(
+            graphs, workers=ctx.obj["jobs"], profile=ctx.obj["profile"]
+        )
+        for tree in trees:
+            if tree is not None:
+                click.echo(tree.summary() + "\n", file=output)
+        return
+
+    sappers = dict(_config(sapper, config) for config in configs)
+    grown = trees_many(
+        graphs, sappers, workers=ctx.obj["jobs"], profile=ctx.obj["profile"]
+    )
+    for component, trees in enumerate(grown):
+        for name, tree in trees.items():
+            if tree is not None:
+                click.echo(f"[{component}] {name}: {tree.summary()}\n", file=output)
+
 
 @main.command()
 @click.argument("sources", type=click.File("r"), nargs=-1)
@@ -109,7 +417,7 @@ def trunk(ctx, sources, output, _open):
     """
     Computes and shows the trunk of the biggest tree on a bibliography collection.
     """
-    show("trunk", ctx.obj["sapper"], sources, output, _open)
+    show("trunk", ctx.obj, sources, output, _open)
 
 
 @main.command()
@@ -128,7 +436,7 @@ def leaf(ctx, sources, output, _open):
     """
     Computes and shows the leaf of the biggest tree on a bibliography collection.
     """
-    show("leaf", ctx.obj["sapper"], sources, output, _open)
+    show("leaf", ctx.obj, sources, output, _open)
 
 
 @main.command()
@@ -146,32 +454,278 @@ def root(ctx, sources, output, _open):
     """
     Computes and shows the root of the biggest tree on a bibliography collection.
     """
-    show("root", ctx.obj["sapper"], sources, output, _open)
+    show("root", ctx.obj, sources, output, _open)
 
 
-def show(part, sapper, sources, output, _open):
-    for graph in load(Collection(*sources)):
-        tree = sapper.tree(graph)
-        items = sorted(
-            [
-                (vs[part], vs["name"], vs.attributes().get("DI"))
-                for vs in tree.vs.select(**{f"{part}_gt": 0})
-            ],
-            key=lambda t: t[0],
-            reverse=True,
+@main.command()
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", "-p", default=8000, show_default=True)
+@click.option(
+    "--trees",
+    help="How many of the latest trees to keep in memory",
+    default=64,
+    show_default=True,
+)
+@click.option(
+    "--large",
+    help="Size in megabytes of a large collection, those can't take every job",
+    default=8,
+    show_default=True,
+)
+@click.option(
+    "--max-upload",
+    help="Size in megabytes of the largest collection accepted",
+    default=512,
+    show_default=True,
+)
+@click.pass_context
+def serve(ctx, host, port, trees, large, max_upload):
+    """
+    Serves trees over HTTP to local applications, growing them in --jobs
+    processes, at least two so that a large collection doesn't hold back the
+    small ones.
+
+    POST the records to /tree, or GET /tree/KEY for a collection posted before,
+    with the parameters in the query string, e.g. /tree?max_roots=10, and
+    format=html to get the widget instead of JSON.
+    """
+    # asyncio takes a while to import, only this command needs it
+    from sap import server
+
+    click.echo(f"Serving trees on http://{host}:{port}", err=True)
+    server.serve(
+        ctx.obj["sapper"],
+        host,
+        port,
+        loops=ctx.obj["loops"],
+        cache=ctx.obj["cache"],
+        workers=ctx.obj["jobs"],
+        trees=trees,
+        large=large * 1024 * 1024,
+        max_upload=max_upload * 1024 * 1024,
+    )
+
+
+BATCH_FORMATS = {
+    ".graphml": writers.FORMAT_GRAPHML,
+    ".csv": writers.FORMAT_CSV,
+    ".jsonl": writers.FORMAT_JSONL,
+    ".sapg": "binary",
+}
+
+
+def _manifest(manifest) -> List[dict]:
+    """
+    Reads the collections out of a batch manifest, see `batch`.
+    """
+    base = os.path.dirname(os.path.abspath(manifest.name))
+    entries = []
+    for number, line in enumerate(manifest, start=1):
+        fields = shlex.split(line, comments=True)
+        if not fields:
+            continue
+        if len(fields) < 2:
+            raise click.BadParameter(
+                f"line {number} needs some sources and an output path",
+                param_hint="MANIFEST",
+            )
+        sources, output, *options = fields
+        output = os.path.join(base, output)
+        entry = {
+            "line": number,
+            "sources": _expand(base, sources),
+            "output": output,
+            "format": BATCH_FORMATS.get(
+                os.path.splitext(output)[1].lower(), writers.FORMAT_GRAPHML
+            ),
+            "params": {},
+        }
+        for option in options:
+            name, _, value = option.partition("=")
+            name = name.replace("-", "_")
+            if name == "format" and value in (*writers.FORMATS, "binary"):
+                entry["format"] = value
+                continue
+            try:
+                if name not in SWEEP_PARAMETERS:
+                    raise ValueError(name)
+                number_value = int(value)
+            except ValueError:
+                raise click.BadParameter(
+                    f"line {number} has an invalid option {option!r}",
+                    param_hint="MANIFEST",
+                )
+            entry["params"][name] = number_value if number_value > 0 else None
+        entries.append(entry)
+    return entries
+
+
+def _expand(base: str, sources: str) -> List[str]:
+    paths = []
+    for source in sources.split(","):
+        source = os.path.join(base, source)
+        if os.path.isdir(source):
+            paths.extend(
+                os.path.join(source, name)
+                for name in sorted(os.listdir(source))
+                if not name.startswith(".")
+                and os.path.isfile(os.path.join(source, name))
+            )
+        elif glob.has_magic(source):
+            paths.extend(sorted(glob.glob(source)))
+        else:
+            paths.append(source)
+    return paths
+
+
+def _batch_entry(obj, entry) -> dict:
+    """
+    Exports the tree of a collection of the batch, errors end up in the
+    result instead of stopping the batch.
+    """
+    start = time.perf_counter()
+    profile = Profile()
+    obj = dict(obj, sapper=copy(obj["sapper"]), profile=profile)
+    vars(obj["sapper"]).update(entry["params"])
+    result = {"output": entry["output"], "line": entry["line"], "status": "ok"}
+    try:
+        if not entry["sources"]:
+            raise ValueError("No sources found")
+        directory = os.path.dirname(entry["output"])
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        mode = "wb" if entry["format"] == "binary" else "w"
+        with ExitStack() as stack:
+            sources = [stack.enter_context(open(path)) for path in entry["sources"]]
+            output = stack.enter_context(open(entry["output"], mode))
+            _export(obj, sources, output, entry["format"])
+    except Exception as error:
+        logger.debug(f"Collection at line {entry['line']} failed", exc_info=True)
+        result.update(status="failed", error=f"{type(error).__name__}: {error}")
+        if os.path.isfile(entry["output"]):
+            os.remove(entry["output"])
+    result["seconds"] = time.perf_counter() - start
+    result["stages"] = {
+        name: total["seconds"] for name, total in profile.totals().items()
+    }
+    result["profile"] = profile
+    return result
+
+
+def _batch_result(entry, future) -> dict:
+    try:
+        return future.result()
+    except Exception as error:
+        return {
+            "output": entry["output"],
+            "line": entry["line"],
+            "status": "failed",
+            "error": f"{type(error).__name__}: {error}",
+            "seconds": 0.0,
+        }
+
+
+def _config(sapper, config):
+    """
+    Reads a named configuration of `describe`, out of the one set with the
+    options.
+    """
+    name, _, params = config.partition(":")
+    if not name:
+        raise click.BadParameter(
+            f"{config!r} needs a name, like name:max_roots=10", param_hint="--config"
         )
+    sapper = copy(sapper)
+    for param in filter(None, params.split(",")):
+        key, _, value = param.partition("=")
+        key = key.strip().replace("-", "_")
+        try:
+            if key not in SWEEP_PARAMETERS:
+                raise ValueError(key)
+            number = int(value)
+        except ValueError:
+            raise click.BadParameter(
+                f"{config!r} has an invalid parameter {param!r}, expected "
+                f"name=value with a name in {SWEEP_PARAMETERS}",
+                param_hint="--config",
+            )
+        setattr(sapper, key, number if number > 0 else None)
+    return name, sapper
+
+
+def _graphs(obj, sources):
+    """
+    Gets the preprocessed graphs of the sources, out of the cache if possible,
+    or straight out of the sources if they are binary graph files. The
+    sources are parsed with --jobs processes.
+    """
+    cache, loops, profile = obj["cache"], obj["loops"], obj["profile"]
+    binaries = [binary.is_graph_file(source) for source in sources]
+    if any(binaries):
+        if not all(binaries):
+            raise click.BadParameter(
+                "binary graph files can't be mixed with bibliographic records",
+                param_hint="SOURCES",
+            )
+        return chain.from_iterable(
+            binary.load(source.name, profile) for source in sources
+        )
+
+    def compute():
+        from sap import parsing
+
+        collection = parsing.collection(sources, obj.get("jobs"), profile)
+        return load(collection, loops=loops, profile=profile)
+
+    if cache is None:
+        return compute()
+    return cache.fetch(sources, compute, loops, profile=profile)
+
+
+def _report(profile, table, path):
+    if table:
+        click.echo(profile.table(), err=True)
+    if path is not None:
+        path.write(profile.to_json() + "\n")
+
+
+def _ratio(value, top, logs: bool) -> float:
+    """
+    How a value compares to the top one, for counts stored as ``ln(1 + count)``
+    when ``logs`` is set.
+    """
+    if not logs:
+        return value / top
+    return math.exp(value - top) * math.expm1(-value) / math.expm1(-top)
+
+
+def show(part, obj, sources, output, _open):
+    graphs = _graphs(obj, sources)
+    profile = obj["profile"]
+    trees = obj["sapper"].tree_many(graphs, workers=obj["jobs"], profile=profile)
+    for tree in trees:
+        if tree is None:
+            continue
+        tagged = tree.vs.select(**{f"{part}_gt": 0})
+        items = [
+            (tagged[i][part], tagged[i]["name"], tagged[i].attributes().get("DI"))
+            for i in top_k(tagged[part])
+        ]
         first, *_ = items
         max_val = first[0]
-        for i, (value, name, doi) in enumerate(items):
-            output.write(
-                " ".join(
-                    [
-                        f"{value/max_val:.2f}",
-                        name,
-                        f"https://dx.doi.org/{doi}" if doi else "",
-                        "\n",
-                    ]
+        # Roots are never logarithms, they count citations
+        logs = obj["sapper"].numbers == NUMBERS_LOG and part != "root"
+        with stage(profile, "write", tree):
+            for i, (value, name, doi) in enumerate(items):
+                output.write(
+                    " ".join(
+                        [
+                            f"{_ratio(value, max_val, logs):.2f}",
+                            name,
+                            f"https://dx.doi.org/{doi}" if doi else "",
+                            "\n",
+                        ]
+                    )
                 )
-            )
-            if i < _open and doi:
-                click.launch(f"https://dx.doi.org/{doi}")
+                if i < _open and doi:
+                    click.launch(f"https://dx.doi.org/{doi}")
@@ -0,0 +1,172 @@
+"""
+Parsing of bibliography collections in a pool of processes, a file per task.
+
+The workers parse the records and their references and work out their labels,
+which takes most of the time, and send back just the fields `load` uses. The
+articles are then merged in order, just like `wostools.Collection` does, so the
+collection and its citation pairs are the same.
+
+This relies on private parts of wostools, checked against wostools 3.0.2, and
+parses in process when they are missing.
+"""
+
+import concurrent.futures
+import io
+import logging
+from contextlib import suppress
+from typing import List, Optional, Sequence, TextIO, Tuple, Union
+
+import wostools
+from wostools import Article, Collection
+from wostools.exceptions import InvalidReference, MissingLabelFields
+
+from sap.profiling import Profile, stage
+
+logger = logging.getLogger(__name__)
+
+FIELDS = (
+    "title",
+    "authors",
+    "year",
+    "journal",
+    "volume",
+    "issue",
+    "page",
+    "doi",
+    "references",
+    "keywords",
+)
+
+# The fields of an article and its labels, ``None`` when it can't have any
+Packed = Tuple[tuple, Optional[Tuple[str, ...]]]
+
+
+class _Article(Article):
+    """
+    Article with its labels worked out by a worker.
+    """
+
+    def __init__(self, packed: Packed):
+        fields, labels = packed
+        super().__init__(**dict(zip(FIELDS, fields)))
+        self._labels = labels
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            raise MissingLabelFields(self)
+        return set(self._labels)
+
+
+class _ParsedCollection(Collection):
+    """
+    Collection of articles parsed somewhere else, see `collection`.
+    """
+
+    def __init__(
+        self,
+        files: Sequence[TextIO],
+        parsed: List[Tuple[_Article, List[Union[_Article, str]]]],
+    ):
+        self._parsed = parsed
+        super().__init__(*files)
+
+    def _preheat(self):
+        # wostools merges every article again whenever the collection is
+        # iterated, and that can change the merged articles, so this does too
+        for article, references in self._parsed:
+            with suppress(MissingLabelFields):
+                self._add_article(article)
+                for reference in references:
+                    if isinstance(reference, str):
+                        logger.info(
+                            f"Ignoring malformed reference '{reference}' from "
+                            f"'{article.label}'"
+                        )
+                    else:
+                        self._add_article(reference)
+
+
+def _supported() -> bool:
+    """
+    Whether wostools still has the private parts used here.
+    """
+    base = getattr(wostools, "base", None)
+    return hasattr(getattr(base, "BaseCollection", None), "_articles") and all(
+        hasattr(Collection, name) for name in ("_add_article", "_preheat")
+    )
+
+
+def _pack(article: Article) -> Packed:
+    try:
+        labels = tuple(article.labels)
+    except MissingLabelFields:
+        labels = None
+    return tuple(getattr(article, field) for field in FIELDS), labels
+
+
+def _parse(text: str) -> List[Tuple[Packed, List[Union[Packed, str]]]]:
+    """
+    Parses the records of a file and their references, the malformed
+    references are kept as text.
+    """
+    parsed = []
+    for article in wostools.base.BaseCollection(io.StringIO(text))._articles():
+        references: List[Union[Packed, str]] = []
+        for reference in article.references:
+            try:
+                references.append(_pack(Article.from_isi_citation(reference)))
+            except InvalidReference:
+                references.append(reference)
+        parsed.append((_pack(article), references))
+    return parsed
+
+
+def collection(
+    sources: Sequence[TextIO],
+    workers: Optional[int] = None,
+    profile: Optional[Profile] = None,
+) -> Collection:
+    """
+    Gets the same collection as ``wostools.Collection(*sources)``, parsing
+    the sources in a pool of processes when asked for more than one worker.
+
+    Only the fields of the articles and their labels are kept, neither the
+    text of the records nor the rest of the fields they had. Sources are
+    parsed in process, with a warning, by versions of wostools without the
+    private parts this relies on.
+
+    :param sources: bibliography files, in order
+    :param int workers: number of processes, ``None`` to parse in process
+    :param Profile profile: gets the time spent parsing, as the ``parse``
+        stage
+    :return: collection ready for `sap.load`
+    """
+    if workers is None or workers <= 1 or len(sources) <= 1:
+        return Collection(*sources)
+    if not _supported():
+        logger.warning(
+            f"Can't parse in parallel with wostools {wostools.__version__}, "
+            "parsing in process"
+        )
+        return Collection(*sources)
+
+    texts = []
+    for source in sources:
+        source.seek(0)
+        texts.append(source.read())
+        source.seek(0)
+    with stage(profile, "parse"):
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            parsed = [
+                (
+                    _Article(article),
+                    [
+                        reference if isinstance(reference, str) else _Article(reference)
+                        for reference in references
+                    ],
+                )
+                for records in executor.map(_parse, texts)
+                for article, references in records
+            ]
+        return _ParsedCollection(sources, parsed)
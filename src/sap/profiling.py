@@ -0,0 +1,177 @@
+"""Per stage timings of the load and tree pipeline."""
+
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+
+class Stage(NamedTuple):
+    """
+    Measurements of a single stage, the counts are ``None`` for the stages
+    that don't work on a graph.
+    """
+
+    name: str
+    seconds: float
+    memory: int
+    vertices_in: Optional[int] = None
+    edges_in: Optional[int] = None
+    vertices_out: Optional[int] = None
+    edges_out: Optional[int] = None
+
+
+def _rss() -> int:
+    """
+    Resident memory of the process in bytes, or its peak where the current
+    one isn't available.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _counts(graph) -> tuple:
+    if graph is None:
+        return None, None
+    return graph.vcount(), graph.ecount()
+
+
+class _Running:
+    """
+    A stage being measured, set ``output`` when the stage doesn't work in
+    place on the graph it got.
+    """
+
+    def __init__(self, profile: "Profile", name: str, graph):
+        self.profile = profile
+        self.name = name
+        self.graph = graph
+        self.output = graph
+
+    def __enter__(self) -> "_Running":
+        self.counts = _counts(self.graph)
+        self.memory = _rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        self.profile.stages.append(
+            Stage(
+                self.name,
+                seconds,
+                _rss() - self.memory,
+                *self.counts,
+                *_counts(self.output),
+            )
+        )
+
+
+class _Discard:
+    """
+    Stands in for a stage when nothing gets measured.
+    """
+
+    @property
+    def output(self):
+        return None
+
+    @output.setter
+    def output(self, graph):
+        pass
+
+    def __enter__(self) -> "_Discard":
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_DISCARD = _Discard()
+
+
+class Profile:
+    """
+    Collects the wall time, memory delta and the vertex and edge counts going
+    in and out of every stage of a run, hand one over to `load`, `Sap.tree` or
+    `Sap.tree_many` to fill it.
+    """
+
+    def __init__(self):
+        self.stages: List[Stage] = []
+
+    def stage(self, name: str, graph=None) -> _Running:
+        """
+        Measures the block under a ``with`` statement as the given stage.
+        """
+        return _Running(self, name, graph)
+
+    def totals(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Adds up the stages with the same name, e.g. of many components.
+        """
+        totals: Dict[str, Dict[str, Any]] = {}
+        for stage in self.stages:
+            total = totals.setdefault(
+                stage.name, {"calls": 0, "seconds": 0.0, "memory": 0}
+            )
+            total["calls"] += 1
+            total["seconds"] += stage.seconds
+            total["memory"] += stage.memory
+        return totals
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "stages": [stage._asdict() for stage in self.stages],
+            "totals": self.totals(),
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def table(self) -> str:
+        """
+        Formats the stages as a plain text table.
+        """
+        lines = [
+            f"{'stage':<14}{'seconds':>10}{'memory MB':>11}"
+            f"{'vertices':>20}{'edges':>20}"
+        ]
+        for stage in self.stages:
+            vertices = _arrow(stage.vertices_in, stage.vertices_out)
+            edges = _arrow(stage.edges_in, stage.edges_out)
+            lines.append(
+                f"{stage.name:<14}{stage.seconds:>10.4f}"
+                f"{stage.memory / 2 ** 20:>11.2f}{vertices:>20}{edges:>20}"
+            )
+        seconds = sum(stage.seconds for stage in self.stages)
+        lines.append(f"{'total':<14}{seconds:>10.4f}")
+        return "\n".join(lines)
+
+    def extend(self, other: "Profile"):
+        self.stages.extend(other.stages)
+
+
+def _arrow(before: Optional[int], after: Optional[int]) -> str:
+    if before is None and after is None:
+        return ""
+    return f"{'' if before is None else before} -> {'' if after is None else after}"
+
+
+def stage(profile: Optional[Profile], name: str, graph=None):
+    """
+    Measures a stage on the profile, if any, otherwise does nothing.
+    """
+    if profile is None:
+        return _DISCARD
+    return profile.stage(name, graph)
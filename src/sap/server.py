@@ -0,0 +1,371 @@
+"""
+Local HTTP service that grows trees, so that a web application doesn't pay for
+starting the command line and parsing its collections on every request.
+
+    POST /tree          grows the tree of the records in the body, as is or as
+                        the files of a multipart/form-data upload
+    GET  /tree/<key>    grows the tree of a collection posted before, by the
+                        ``collection`` key it got back
+    GET  /health
+
+The tree requests take the `Sap` parameters in the query string, negative
+values meaning unlimited like on the command line, and ``format=html`` to get
+the `Widget` instead of JSON, e.g. ``/tree?max_roots=10&format=html``.
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+from collections import OrderedDict
+from copy import copy
+from email import policy
+from email.parser import BytesParser
+from functools import partial
+from http import HTTPStatus
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from sap import (
+    LOOPS_COMPONENTS,
+    SWEEP_PARAMETERS,
+    Sap,
+    _largest,
+    _with_components,
+    load,
+    wostools,
+)
+from sap.cache import GraphCache
+from sap.widget import Widget
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+DEFAULT_TREES = 64
+DEFAULT_LARGE = 8 * 1024 * 1024
+DEFAULT_MAX_UPLOAD = 512 * 1024 * 1024
+
+FORMAT_JSON = "json"
+FORMAT_HTML = "html"
+FORMATS = (FORMAT_JSON, FORMAT_HTML)
+
+CONTENT_TYPES = {
+    FORMAT_JSON: "application/json",
+    FORMAT_HTML: "text/html; charset=utf-8",
+}
+METADATA = ("title", "authors", "year", "journal", "doi")
+KEY = re.compile(r"[0-9a-f]{64}")
+
+
+class HTTPError(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _parameters(query: Dict[str, List[str]]) -> Tuple[Dict, str]:
+    """
+    Reads the `Sap` parameters and the format of the response out of a query.
+    """
+    parameters = {}
+    for name, values in query.items():
+        if name == "format":
+            continue
+        if name not in SWEEP_PARAMETERS:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Unknown parameter {name!r}")
+        try:
+            value = int(values[-1])
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be an integer")
+        parameters[name] = value if value > 0 else None
+    _format = query.get("format", [FORMAT_JSON])[-1]
+    if _format not in FORMATS:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"format must be one of {FORMATS}")
+    return parameters, _format
+
+
+def _uploads(content_type: str, body: bytes) -> List[str]:
+    """
+    Gets the files of a request, the whole body or every part of a multipart
+    form.
+    """
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        files = [part.get_payload(decode=True) for part in message.iter_parts()]
+    else:
+        files = [body]
+    files = [data for data in files if data]
+    if not files:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "No records in the request")
+    return [data.decode("utf-8-sig", errors="replace") for data in files]
+
+
+def _grow(
+    sapper: Sap,
+    loops: str,
+    cache: Optional[GraphCache],
+    key: str,
+    texts: Optional[List[str]],
+    _format: str,
+) -> bytes:
+    """
+    Grows the tree of a collection in a worker process, out of its records
+    or, without them, out of the cache.
+    """
+    if texts is None:
+        graph = cache.get(key) if cache is not None else None
+        if graph is None:
+            raise KeyError(key)
+        graphs = _with_components(graph)
+    else:
+        sources = [io.StringIO(text) for text in texts]
+
+        def compute():
+            return load(wostools.Collection(*sources), loops=loops)
+
+        if cache is None:
+            graphs = compute()
+        else:
+            graphs = cache.fetch(sources, compute, loops)
+    graph = _largest(graphs)
+    if graph is None:
+        raise ValueError("There are no citations among the records")
+
+    if _format == FORMAT_HTML:
+        return Widget(sapper.tree(graph))._repr_html_().encode()
+
+    tree = sapper.tree(graph, compact=True)
+    fields = [field for field in METADATA if field in graph.vs.attributes()]
+    metadata = tree.join(graph, *fields)
+    result = {
+        "collection": key,
+        "vertices": graph.vcount(),
+        "edges": graph.ecount(),
+        "parameters": {name: getattr(sapper, name) for name in SWEEP_PARAMETERS},
+    }
+    for part in ("root", "trunk", "leaf"):
+        values = getattr(tree, part).tolist()
+        result[part] = [
+            {
+                "label": tree.labels[position],
+                "value": values[position],
+                **{field: metadata[field][position] for field in fields},
+            }
+            for position in tree.ranked(part)
+        ]
+    return json.dumps(result, default=str).encode()
+
+
+class Server:
+    """
+    Grows trees off the event loop in a pool of processes and keeps the
+    latest ones around, by the content of their collection and parameters.
+    Requests for the same tree that arrive while it grows wait for it.
+
+    Collections of more than ``large`` bytes of records can't take every
+    worker, there are always at least two, so the small ones don't wait behind
+    the large ones. Collections posted before the server started count as
+    large, as the size of their records is unknown.
+
+    :param Sap sapper: default parameters, requests can change them
+    :param str loops: how to break the citation cycles, see `LOOP_POLICIES`
+    :param GraphCache cache: keeps the parsed collections, needed to refer to
+        the collections posted before
+    :param int workers: processes growing trees, at least two
+    :param int trees: how many trees to keep
+    :param int large: size in bytes above which a collection is large
+    :param int max_upload: size in bytes of the largest accepted request
+    """
+
+    def __init__(
+        self,
+        sapper: Sap,
+        loops: str = LOOPS_COMPONENTS,
+        cache: Optional[GraphCache] = None,
+        workers: int = 2,
+        trees: int = DEFAULT_TREES,
+        large: int = DEFAULT_LARGE,
+        max_upload: int = DEFAULT_MAX_UPLOAD,
+    ):
+        self.sapper = sapper
+        self.loops = loops
+        self.cache = cache
+        self.keys = cache or GraphCache()
+        self.workers = max(workers, 2)
+        self.trees: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self.max_trees = trees
+        self.large = large
+        self.sizes: Dict[str, int] = {}
+        self.max_upload = max_upload
+        self.growing: Dict[tuple, asyncio.Future] = {}
+        self.executor: Optional[concurrent.futures.Executor] = None
+        self.large_slots: Optional[asyncio.Semaphore] = None
+
+    async def start(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        """
+        Starts listening, returns the `asyncio.Server`.
+        """
+        # Forked workers would keep the sockets of the connections open
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.large_slots = asyncio.Semaphore(self.workers - 1)
+        return await asyncio.start_server(self._handle, host, port)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        server = await self.start(host, port)
+        for socket in server.sockets:
+            logger.info(f"Serving trees on {socket.getsockname()}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            status, content_type, body = await self._respond(reader)
+        except HTTPError as error:
+            status, content_type = error.status, CONTENT_TYPES[FORMAT_JSON]
+            body = json.dumps({"error": str(error)}).encode()
+        except Exception as error:
+            logger.exception("Failed to answer a request")
+            status, content_type = (
+                HTTPStatus.INTERNAL_SERVER_ERROR,
+                CONTENT_TYPES[FORMAT_JSON],
+            )
+            body = json.dumps({"error": f"{type(error).__name__}: {error}"}).encode()
+        head = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        try:
+            writer.write(head.encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(
+        self, reader: asyncio.StreamReader
+    ) -> Tuple[HTTPStatus, str, bytes]:
+        try:
+            method, target, _ = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1")
+                if not line.strip():
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if length > self.max_upload:
+                raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Too large")
+            body = await reader.readexactly(length)
+        except (ValueError, asyncio.IncompleteReadError):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request")
+
+        url = urlsplit(target)
+        path = url.path.rstrip("/")
+        if path == "/health":
+            body = json.dumps({"status": "ok", "trees": len(self.trees)}).encode()
+            return HTTPStatus.OK, CONTENT_TYPES[FORMAT_JSON], body
+        if path == "/tree" and method == "POST":
+            texts = _uploads(headers.get("content-type", ""), body)
+            key = self.keys.key([io.StringIO(text) for text in texts], self.loops)
+            size = self.sizes[key] = len(body)
+        elif path.startswith("/tree/") and method == "GET":
+            key, texts = path[len("/tree/") :], None
+            size = self._cached_size(key)
+        elif path == "/tree" or path.startswith("/tree/"):
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, f"{method} not allowed")
+        else:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Nothing at {url.path}")
+
+        parameters, _format = _parameters(parse_qs(url.query))
+        body = await self._tree(key, texts, size, parameters, _format)
+        return HTTPStatus.OK, CONTENT_TYPES[_format], body
+
+    def _cached_size(self, key: str) -> int:
+        """
+        Size of the records of a collection posted before, or more than
+        ``large`` when they were posted before the server started.
+        """
+        if self.cache is None or not KEY.fullmatch(key):
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Unknown collection {key}")
+        if not os.path.exists(self.cache._path(key)):
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Unknown collection {key}")
+        return self.sizes.get(key, self.large + 1)
+
+    async def _tree(
+        self,
+        key: str,
+        texts: Optional[List[str]],
+        size: int,
+        parameters: Dict,
+        _format: str,
+    ) -> bytes:
+        sapper = copy(self.sapper)
+        vars(sapper).update(parameters)
+        entry = (
+            key,
+            _format,
+            *(getattr(sapper, name) for name in SWEEP_PARAMETERS),
+        )
+        if entry in self.trees:
+            self.trees.move_to_end(entry)
+            return self.trees[entry]
+        growing = self.growing.get(entry)
+        if growing is None:
+            growing = asyncio.ensure_future(
+                self._grow(entry, sapper, key, texts, size, _format)
+            )
+            self.growing[entry] = growing
+            growing.add_done_callback(lambda _: self.growing.pop(entry, None))
+        return await asyncio.shield(growing)
+
+    async def _grow(self, entry, sapper, key, texts, size, _format) -> bytes:
+        job = partial(_grow, sapper, self.loops, self.cache, key, texts, _format)
+        loop = asyncio.get_running_loop()
+        try:
+            if size > self.large:
+                async with self.large_slots:
+                    body = await loop.run_in_executor(self.executor, job)
+            else:
+                body = await loop.run_in_executor(self.executor, job)
+        except KeyError:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Unknown collection {key}")
+        except (ValueError, TypeError) as error:
+            # Sap raises a TypeError for trees without roots
+            raise HTTPError(HTTPStatus.BAD_REQUEST, str(error))
+        self.trees[entry] = body
+        while len(self.trees) > self.max_trees:
+            self.trees.popitem(last=False)
+        return body
+
+
+def serve(
+    sapper: Sap,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    **kwargs,
+):
+    """
+    Runs a `Server` until interrupted, see `Server` for the other arguments.
+    """
+    asyncio.run(Server(sapper, **kwargs).serve(host, port))
@@ -1,22 +1,46 @@
-import os
-from xml.etree.ElementTree import TreeBuilder, Element, tostring
-from xml.dom.minidom import parse
-
-import igraph as ig
-from igraph import VertexSeq
+from __future__ import annotations
 
-
-def _sorted_seq(graph: ig.Graph, by: str):
-    vertices = graph.vs.select(**{f"{by}_gt": 0})
-    order = [
-        index
-        for index, _ in sorted(
-            zip(vertices.indices, vertices[by]),
-            key=(lambda item: item[1]),
-            reverse=True,
-        )
-    ]
-    return graph.vs[order]
+import os
+import re
+from functools import lru_cache
+from html import escape
+from typing import TYPE_CHECKING, List, Optional
+
+from sap import top_k
+
+if TYPE_CHECKING:
+    import igraph as ig
+
+DEFAULT_LIMIT = 200
+REFERENCE_CACHE_SIZE = 100000
+FIELDS = (
+    "label",
+    "authors",
+    "year",
+    "title",
+    "journal",
+    "volume",
+    "issue",
+    "page",
+    "doi",
+)
+PLACEHOLDER = re.compile(r"<!-- (ROOT|TRUNK|LEAF) ARTICLES -->")
+
+
+def _sorted_seq(graph: ig.Graph, by: str, limit: Optional[int] = None, page: int = 0):
+    """
+    Gets the indices of the vertices of a group, by their value in the group,
+    and how many vertices the group has.
+    """
+    values = graph.vs[by]
+    # Exact counts can be too big for floats
+    tagged = [index for index, value in enumerate(values) if value > 0]
+    tagged_values = [values[index] for index in tagged]
+    if limit is None:
+        ranked = top_k(tagged_values)
+    else:
+        ranked = top_k(tagged_values, (page + 1) * limit)[page * limit :]
+    return [tagged[index] for index in ranked], len(tagged)
 
 
 def _ensure_dots(author: str) -> str:
@@ -26,108 +50,145 @@ def _ensure_dots(author: str) -> str:
     return f"{author}."
 
 
-def _span(builder, name, value):
+def _span(out: List[str], name: str, value):
     if not value:
         return
-    builder.start("span", {"class": f"Article-{name}"})
-    builder.data(value)
-    builder.end("span")
-
+    out.append(f'<span class="Article-{name}">{escape(str(value), False)}</span>')
+
+
+@lru_cache(maxsize=REFERENCE_CACHE_SIZE)
+def _formatted_reference(
+    label, authors, year, title, journal, volume, issue, page, doi
+) -> str:
+    """
+    Formats an article as HTML, the formatted articles are kept around so
+    that rendering the same articles again is cheap.
+    """
+    out = ['<div class="Article"']
+    if label is not None:
+        out.append(f' id="{escape(str(label))}"')
+    out.append(">")
+
+    if authors:
+        _span(out, "authors", "; ".join([_ensure_dots(author) for author in authors]))
+        out.append(" ")
+
+    if year:
+        _span(out, "year", f"({year})")
+        out.append(". ")
+
+    if title:
+        _span(out, "title", title)
+        out.append(". ")
+
+    if journal or volume:
+        journal = journal or ""
+        volume = volume or ""
+
+        out.append("<em>")
+        _span(out, "journal", journal.title())
+        if journal and volume:
+            out.append(", ")
+            _span(out, "volume", volume.title())
+        out.append("</em>")
 
-def _formatted_reference(vertex: ig.Vertex):
-    attributes = vertex.attributes()
-    builder = TreeBuilder()
-    builder.start("div", {"class": "Article", "id": attributes.get("label")})
+        if issue:
+            _span(out, "issue", f"({issue})")
 
-    if attributes.get("authors", []):
-        _span(
-            builder,
-            "authors",
-            "; ".join([_ensure_dots(author) for author in vertex["authors"]]),
-        )
-        builder.data(" ")
+        if page:
+            out.append(", ")
+            _span(out, "page", page)
 
-    if attributes.get("year"):
-        _span(builder, "year", f"({vertex['year']})")
-        builder.data(". ")
+        out.append(".")
 
-    if attributes.get("title"):
-        _span(builder, "title", vertex["title"])
-        builder.data(". ")
+    if doi:
+        url = escape(f"https://dx.doi.org/{doi}")
+        out.append(
+            f' <a class="Article-doi" href="{url}" target="_blank"'
+            f' rel="noreferrer">{url}</a>'
+        )
 
-    if attributes.get("journal") or attributes.get("volume"):
-        journal = attributes.get("journal", "") or ""
-        volume = attributes.get("volume", "") or ""
-        issue = attributes.get("issue", "") or ""
-        page = attributes.get("page", "") or ""
+    out.append("</div>")
+    return "".join(out)
+
+
+def _formatted_articles(
+    out: List[str], graph: ig.Graph, indices: List[int], total: int, first: int
+):
+    """
+    Appends the articles of a group to the output, reading every attribute
+    of the articles at once, with a note when only some of them are shown.
+    """
+    out.append('<div class="Article-collection">')
+    vertices = graph.vs[indices]
+    present = set(graph.vs.attributes())
+    columns = [
+        vertices[name] if name in present else [None] * len(indices) for name in FIELDS
+    ]
+    # Lists can't be cache keys
+    authors = FIELDS.index("authors")
+    columns[authors] = [
+        None if names is None else tuple(names) for names in columns[authors]
+    ]
+    for values in zip(*columns):
+        out.append(_formatted_reference(*values))
+    if len(indices) < total:
+        out.append(
+            f'<div class="Article-more">Showing {first + 1}'
+            f" to {first + len(indices)} of {total} articles</div>"
+        )
+    out.append("</div>")
 
-        builder.start("em", {})
-        _span(builder, "journal", journal.title())
-        if journal and volume:
-            builder.data(", ")
-            _span(builder, "volume", volume.title())
-        builder.end("em")
 
-        if issue:
-            _span(builder, "issue", f"({issue})")
+@lru_cache(maxsize=None)
+def _template() -> str:
+    with open(os.path.join(os.path.dirname(__file__), "template.html")) as f:
+        return f.read()
 
-        if page:
-            builder.data(", ")
-            _span(builder, "page", page)
-
-        builder.data(".")
-
-    if attributes.get("doi"):
-        builder.data(" ")
-        doi = attributes.get("doi")
-        url = f"https://dx.doi.org/{doi}"
-        builder.start(
-            "a",
-            {
-                "class": "Article-doi",
-                "href": url,
-                "target": "_blank",
-                "rel": "noreferrer",
-            },
-        )
-        builder.data(url)
-        builder.end("a")
 
-    builder.end("div")
-    return builder.close()
+@lru_cache(maxsize=None)
+def _template_parts() -> List[str]:
+    """
+    The template split around its placeholders, the group names are at the
+    odd positions.
+    """
+    return PLACEHOLDER.split(_template())
 
 
-def _formatted_articles(seq: VertexSeq):
-    formatted = Element("div", {"class": "Article-collection"})
-    for vertex in seq:
-        formatted.append(_formatted_reference(vertex))
-    return tostring(formatted, encoding="utf-8").decode()
+def __getattr__(name: str):
+    if name == "TEMPLATE":
+        return _template()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-with open(os.path.join(os.path.dirname(__file__), "template.html")) as f:
-    TEMPLATE = f.read()
+class Widget:
+    """
+    Shows the root, trunk and leaf articles of a tree in a notebook.
 
+    :param int limit: most articles shown per group, ``None`` for all of them
+    :param int page: which ``limit`` articles of every group to show
+    """
 
-class Widget:
-    def __init__(self, graph: ig.Graph):
+    def __init__(
+        self, graph: ig.Graph, limit: Optional[int] = DEFAULT_LIMIT, page: int = 0
+    ):
         self.graph = graph
+        self.limit = limit
+        self.page = page
 
     def _repr_html_(self):
-        html = TEMPLATE[:]
-        html = html.replace(
-            "<!-- ROOT ARTICLES -->",
-            _formatted_articles(_sorted_seq(self.graph, "root")),
-        )
-        html = html.replace(
-            "<!-- TRUNK ARTICLES -->",
-            _formatted_articles(_sorted_seq(self.graph, "trunk")),
-        )
-        html = html.replace(
-            "<!-- LEAF ARTICLES -->",
-            _formatted_articles(_sorted_seq(self.graph, "leaf")),
-        )
-        return html
-
-
-def display(graph):
-    return Widget(graph)
+        out: List[str] = []
+        first = 0 if self.limit is None else self.page * self.limit
+        for position, part in enumerate(_template_parts()):
+            if position % 2 == 0:
+                out.append(part)
+                continue
+            indices, total = _sorted_seq(
+                self.graph, part.lower(), self.limit, self.page
+            )
+            _formatted_articles(out, self.graph, indices, total, first)
+        return "".join(out)
+
+
+def display(graph, limit: Optional[int] = DEFAULT_LIMIT, page: int = 0):
+    return Widget(graph, limit, page)
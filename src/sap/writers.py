@@ -0,0 +1,245 @@
+"""
+Writers for trees, in GraphML or as a record per vertex in CSV or JSON Lines,
+that write to the output a chunk of vertices at a time.
+"""
+
+from __future__ import annotations
+
+import csv
+import json
+from typing import TYPE_CHECKING, Iterator, List, Optional, Sequence, TextIO
+from xml.sax.saxutils import escape, quoteattr
+
+from sap import np
+
+if TYPE_CHECKING:
+    from igraph import Graph
+
+FORMAT_GRAPHML = "graphml"
+FORMAT_CSV = "csv"
+FORMAT_JSONL = "jsonl"
+FORMATS = (FORMAT_GRAPHML, FORMAT_CSV, FORMAT_JSONL)
+
+CHUNK_SIZE = 10000
+
+
+def _tagged(graph: Graph) -> np.ndarray:
+    """
+    Mask of the vertices tagged as root, trunk or leaf.
+    """
+    mask = np.zeros(graph.vcount(), dtype=bool)
+    for attr in ("root", "trunk", "leaf"):
+        mask |= np.array(graph.vs[attr]) > 0
+    return mask
+
+
+def _chunks(indices: Sequence[int], chunk_size: int) -> Iterator[List[int]]:
+    for start in range(0, len(indices), chunk_size):
+        yield list(indices[start : start + chunk_size])
+
+
+def _records(graph: Graph, tagged_only: bool, chunk_size: int) -> Iterator[dict]:
+    """
+    Goes over the vertices a chunk at a time as records with an ``id``, the
+    vertex attributes and the ids of the vertices it ``cites``. Ids are the
+    positions of the records in the output.
+    """
+    if tagged_only:
+        keep = _tagged(graph)
+        vertices: Sequence[int] = np.flatnonzero(keep).tolist()
+    else:
+        keep = np.ones(graph.vcount(), dtype=bool)
+        vertices = range(graph.vcount())
+    ids = (np.cumsum(keep) - 1).tolist()
+    names = graph.vs.attributes()
+    for chunk in _chunks(vertices, chunk_size):
+        selected = graph.vs[chunk]
+        columns = [selected[name] for name in names]
+        for position, index in enumerate(chunk):
+            record = {"id": ids[index]}
+            record.update(
+                (name, column[position]) for name, column in zip(names, columns)
+            )
+            record["cites"] = [
+                ids[cited]
+                for cited in graph.neighbors(index, mode="out")
+                if keep[cited]
+            ]
+            yield record
+
+
+def write_jsonl(
+    graph: Graph,
+    output: TextIO,
+    tagged_only: bool = False,
+    chunk_size: int = CHUNK_SIZE,
+):
+    """
+    Writes a JSON object per vertex with an ``id``, its attributes and the ids
+    of the vertices it ``cites``.
+
+    :param bool tagged_only: write only the roots, trunk and leaves and the
+        citations among them
+    """
+    lines = []
+    for record in _records(graph, tagged_only, chunk_size):
+        lines.append(json.dumps(record, default=str) + "\n")
+        if len(lines) >= chunk_size:
+            output.write("".join(lines))
+            lines = []
+    output.write("".join(lines))
+
+
+def _cell(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple, set)):
+        return "; ".join(str(item) for item in value)
+    return str(value)
+
+
+def write_csv(
+    graph: Graph,
+    output: TextIO,
+    tagged_only: bool = False,
+    chunk_size: int = CHUNK_SIZE,
+):
+    """
+    Writes a row per vertex with an ``id``, its attributes and the ids of the
+    vertices it ``cites``, lists are joined with ``"; "``.
+
+    :param bool tagged_only: write only the roots, trunk and leaves and the
+        citations among them
+    """
+    writer = csv.writer(output, lineterminator="\n")
+    names = ["id", *graph.vs.attributes(), "cites"]
+    writer.writerow(names)
+    rows = []
+    for record in _records(graph, tagged_only, chunk_size):
+        rows.append([_cell(record[name]) for name in names])
+        if len(rows) >= chunk_size:
+            writer.writerows(rows)
+            rows = []
+    writer.writerows(rows)
+
+
+GRAPHML_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<graphml xmlns="http://graphml.graphdrawing.org/xmlns"
+         xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+         xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns
+         http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">
+"""
+
+
+def _graphml_type(values: Iterator) -> Optional[str]:
+    """
+    GraphML type of an attribute out of its values, ``None`` for those that
+    igraph leaves out too, like lists.
+    """
+    kinds = {type(value) for value in values if value is not None}
+    if kinds and kinds <= {bool}:
+        return "boolean"
+    if kinds <= {int, float}:
+        return "double"
+    if kinds <= {str, int, float, bool}:
+        return "string"
+    return None
+
+
+def _graphml_value(value, kind: str) -> Optional[str]:
+    # Like igraph, missing strings are written as "None"
+    if kind == "string":
+        return escape(str(value))
+    if value is None or value != value:
+        return None
+    if kind == "boolean":
+        return "true" if value else "false"
+    try:
+        return format(float(value), ".15g")
+    except OverflowError:
+        # Exact counts past the range of floats
+        return str(value)
+
+
+def write_graphml(
+    graph: Graph,
+    output: TextIO,
+    tagged_only: bool = False,
+    chunk_size: int = CHUNK_SIZE,
+):
+    """
+    Writes a graph as GraphML with the vertex attributes igraph would write,
+    the ``<key>`` elements first, then the vertices and then the citations,
+    a chunk at a time. Vertex ids are the positions of the vertices in the
+    output.
+
+    :param bool tagged_only: write only the roots, trunk and leaves and the
+        citations among them, same as writing a cleared tree
+    """
+    kinds = {}
+    for name in graph.vs.attributes():
+        values = (
+            value
+            for chunk in _chunks(range(graph.vcount()), chunk_size)
+            for value in graph.vs[chunk][name]
+        )
+        kind = _graphml_type(values)
+        if kind is not None:
+            kinds[name] = kind
+
+    output.write(GRAPHML_HEADER)
+    for name, kind in kinds.items():
+        output.write(
+            f"  <key id={quoteattr('v_' + name)} for=\"node\" "
+            f'attr.name={quoteattr(name)} attr.type="{kind}"/>\n'
+        )
+    output.write('  <graph id="G" edgedefault="directed">\n')
+
+    lines = []
+    for record in _records(graph, tagged_only, chunk_size):
+        lines.append(f'    <node id="n{record["id"]}">\n')
+        for name, kind in kinds.items():
+            value = _graphml_value(record[name], kind)
+            if value is not None:
+                lines.append(
+                    f"      <data key={quoteattr('v_' + name)}>{value}</data>\n"
+                )
+        lines.append("    </node>\n")
+        if len(lines) >= chunk_size:
+            output.write("".join(lines))
+            lines = []
+    output.write("".join(lines))
+
+    lines = []
+    for record in _records(graph, tagged_only, chunk_size):
+        for cited in record["cites"]:
+            lines.append(f'    <edge source="n{record["id"]}" target="n{cited}"/>\n')
+        if len(lines) >= chunk_size:
+            output.write("".join(lines))
+            lines = []
+    output.write("".join(lines))
+    output.write("  </graph>\n</graphml>\n")
+
+
+WRITERS = {
+    FORMAT_GRAPHML: write_graphml,
+    FORMAT_CSV: write_csv,
+    FORMAT_JSONL: write_jsonl,
+}
+
+
+def write(
+    graph: Graph,
+    output: TextIO,
+    format: str = FORMAT_GRAPHML,
+    tagged_only: bool = False,
+    chunk_size: int = CHUNK_SIZE,
+):
+    """
+    Writes a graph in one of `FORMATS`.
+    """
+    try:
+        writer = WRITERS[format]
+    except KeyError:
+        raise ValueError(f"Unknown format {format!r}, expected one of {FORMATS}")
+    writer(graph, output, tagged_only=tagged_only, chunk_size=chunk_size)
@@ -2,9 +2,67 @@
 
 """Tests for `python-sap` package."""
 
+import asyncio
+import io
+import re
+import json
+import os
+import pickle
+import random
+import subprocess
+import sys
+
+import pytest
+import wostools
 from click.testing import CliRunner
+from igraph import Graph
+
+from sap import (
+    ENGINES,
+    LOOP_POLICIES,
+    LOOPS_FEEDBACK,
+    NUMBER_POLICIES,
+    SWEEP_PARAMETERS,
+    Collection,
+    Sap,
+    _break_loops,
+    _with_components,
+    annotate,
+    binary,
+    cli,
+    giant,
+    load,
+    parsing,
+    top_k,
+    trees,
+    writers,
+)
+from sap.cache import GraphCache
+from sap.profiling import Profile
+from sap.server import Server
+from sap.widget import Widget
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), "..", "example", "sample.isi")
+
+
+def _giant():
+    with open(EXAMPLE) as source:
+        return giant(Collection(source))
 
-from sap import cli
+
+def _doubling(layers):
+    """Layers of two articles, each citing both of the next layer."""
+    return Graph(
+        n=2 * layers,
+        edges=[
+            (2 * layer + a, 2 * layer + 2 + b)
+            for layer in range(layers - 1)
+            for a in (0, 1)
+            for b in (0, 1)
+        ],
+        directed=True,
+        vertex_attrs={"name": [str(i) for i in range(2 * layers)]},
+    )
 
 
 def test_command_line_interface():
@@ -16,3 +74,512 @@ def test_command_line_interface():
     help_result = runner.invoke(cli.main, ["--help"])
     assert help_result.exit_code == 0
     assert "Show this message and exit." in help_result.output
+
+
+def test_engines_agree():
+    """The numpy engine gives the same numbers as the python one."""
+    graph = _giant()
+    python_tree = Sap(engine="python").tree(graph, clear=False)
+    numpy_tree = Sap(engine="numpy").tree(graph, clear=False)
+    for attr in ("_connections", "_raw_sap", "_elaborate_sap", "sap", "trunk"):
+        assert python_tree.vs[attr] == numpy_tree.vs[attr]
+
+    # Logarithms as large as a few hundreds too, summed in a different order
+    generator = random.Random(0)
+    layers, width = 300, 50
+    deep = Graph(
+        n=layers * width,
+        edges=[
+            (layer * width + position, (layer - 1) * width + cited)
+            for layer in range(1, layers)
+            for position in range(width)
+            for cited in {int(width * generator.random() ** 3) for _ in range(4)}
+        ],
+        directed=True,
+        vertex_attrs={"name": [str(index) for index in range(layers * width)]},
+    )
+    trees = [
+        Sap(engine=engine, numbers="log", max_leaf_age=None).tree(deep, clear=False)
+        for engine in ENGINES
+    ]
+    assert max(trees[0].vs["sap"]) > 700
+    for attr in ("_connections", "_elaborate_sap", "sap", "trunk"):
+        assert trees[0].vs[attr] == trees[1].vs[attr]
+
+
+def test_numbers_keep_the_ranking():
+    """Every policy for the numbers ranks like exact integers, or overflows."""
+    graph = _giant()
+    exact = Sap().tree(graph)
+    for engine in ENGINES:
+        for numbers in NUMBER_POLICIES:
+            tree = Sap(engine=engine, numbers=numbers).tree(graph)
+            for attr in ("root", "trunk", "leaf"):
+                assert top_k(tree.vs[attr]) == top_k(exact.vs[attr])
+
+    # The same leaves make the connections cut, before any is left out
+    unlimited = {"max_roots": None, "max_leaves": None}
+    leaves = Sap(**unlimited).tree(graph, clear=False).vs["leaf"]
+    for numbers in NUMBER_POLICIES:
+        tree = Sap(numbers=numbers, **unlimited).tree(graph, clear=False)
+        assert [value > 0 for value in tree.vs["leaf"]] == [v > 0 for v in leaves]
+
+    # Every article cites both articles of the layer before, 2 ** 79 paths
+    layers = 80
+    deep = Graph(
+        n=2 * layers,
+        edges=[
+            (2 * layer + i, 2 * (layer - 1) + j)
+            for layer in range(1, layers)
+            for i in (0, 1)
+            for j in (0, 1)
+        ],
+        directed=True,
+    )
+    deep.vs["name"] = [str(index) for index in range(2 * layers)]
+    deep.vs["year"] = 2000
+    python_tree = Sap(engine="python").tree(deep)
+    for engine in ENGINES:
+        with pytest.raises(OverflowError):
+            Sap(engine=engine, numbers="int64").tree(deep)
+        assert Sap(engine=engine).tree(deep).vs["sap"] == python_tree.vs["sap"]
+    assert max(python_tree.vs["sap"]) > 2**79
+
+
+def test_annotate_restores_metadata():
+    """Loading without metadata and annotating later gives the same graph."""
+    with open(EXAMPLE) as source:
+        collection = Collection(source)
+        graph = giant(collection)
+        bare = giant(collection, metadata=False)
+        assert set(bare.vs.attributes()) == {"name", "label", "year"}
+        annotated = annotate(bare, collection)
+    assert set(annotated.vs.attributes()) == set(graph.vs.attributes())
+    assert annotated.vs["title"] == graph.vs["title"]
+    assert annotated.get_edgelist() == graph.get_edgelist()
+
+
+def test_cache_skips_parsing(tmp_path, monkeypatch):
+    """A second command on the same sources reads the graphs from the cache."""
+    runner = CliRunner()
+    options = ["--cache-dir", str(tmp_path)]
+    first = runner.invoke(cli.main, [*options, "root", EXAMPLE])
+    assert first.exit_code == 0
+    (entry,) = tmp_path.glob("*.pickle")
+    with open(EXAMPLE) as source:
+        whole = next(load(Collection(source)))
+    with open(entry, "rb") as cached:
+        assert pickle.load(cached).vcount() == whole.vcount()
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("The sources should not be parsed again")
+
+    monkeypatch.setattr(cli, "load", _fail)
+    second = runner.invoke(cli.main, [*options, "root", EXAMPLE])
+    assert second.exit_code == 0
+    assert second.output == first.output
+
+
+def test_parallel_parsing_matches_collection(monkeypatch):
+    """Parsing the sources in a pool gives the same graph as in process."""
+    bits = os.path.join(os.path.dirname(EXAMPLE), "bit-pattern-savedrecs.txt")
+    with open(EXAMPLE) as sample, open(bits) as bit_pattern:
+        sources = [sample, bit_pattern]
+        expected = next(load(Collection(*sources)))
+        graph = next(load(parsing.collection(sources, workers=2)))
+        # Without the private parts of wostools it relies on
+        monkeypatch.delattr(wostools, "base")
+        fallback = parsing.collection(sources, workers=2)
+    assert type(fallback) is Collection
+    assert graph.vs["name"] == expected.vs["name"]
+    assert graph.get_edgelist() == expected.get_edgelist()
+    for attr in expected.vs.attributes():
+        assert graph.vs[attr] == expected.vs[attr]
+
+
+@pytest.mark.parametrize(
+    "example",
+    sorted(
+        path
+        for path in os.listdir(os.path.dirname(EXAMPLE))
+        if not path.endswith(".ipynb")
+    ),
+)
+def test_cli_grows_the_examples(example, tmp_path):
+    """Every bundled example gets roots and a tree with the default options."""
+    path = os.path.join(os.path.dirname(EXAMPLE), example)
+    runner = CliRunner()
+    roots = runner.invoke(cli.main, ["--no-cache", "root", path])
+    assert roots.exit_code == 0 and roots.output
+    output = tmp_path / "tree.graphml"
+    tree = runner.invoke(cli.main, ["--no-cache", "export", path, "-o", str(output)])
+    assert tree.exit_code == 0 and Graph.Read_GraphML(str(output)).vcount() > 0
+
+
+def test_tree_many_keeps_order():
+    """Trees computed in a pool come out in order, None for bad graphs."""
+    graph = _giant()
+    sapper = Sap()
+    trees = list(sapper.tree_many([graph, Graph(directed=True), graph], workers=2))
+    assert trees[1] is None
+    expected = sapper.tree(graph)
+    for tree in (trees[0], trees[2]):
+        assert tree.vs["name"] == expected.vs["name"]
+        assert tree.vs["sap"] == expected.vs["sap"]
+
+
+def test_break_loops_policies():
+    """Every loop policy leaves a DAG, the feedback ones keep more citations."""
+    graph = Graph(
+        n=5, edges=[(0, 1), (1, 2), (2, 0), (2, 3), (3, 4), (4, 3)], directed=True
+    )
+    acyclic = {policy: _break_loops(graph, policy) for policy in LOOP_POLICIES}
+    assert all(tree.is_dag() for tree in acyclic.values())
+    assert acyclic["components"].get_edgelist() == [(2, 3)]
+    assert acyclic["feedback"].ecount() == acyclic["minimal"].ecount() == 4
+
+
+def test_update_matches_tree():
+    """Updating a tree with new citations gives the same as growing it again."""
+    with open(EXAMPLE) as source:
+        collection = Collection(source)
+        graph = giant(collection)
+        pairs = list(collection.citation_pairs())
+    names = graph.vs["name"]
+    late = {(names[e.source], names[e.target]) for e in graph.es if e.index % 7 == 0}
+    new_pairs = [pair for pair in pairs if (pair[0].label, pair[1].label) in late]
+    old_graph = graph.copy()
+    old_graph.delete_edges([edge.index for edge in graph.es if edge.index % 7 == 0])
+
+    sapper = Sap(default_clear_graph=False)
+    updated = sapper.update(sapper.tree(old_graph), new_pairs)
+    expected = sapper.tree(graph)
+    for attr in ("root", "leaf", "trunk", "sap", "_connections"):
+        assert dict(zip(updated.vs["name"], updated.vs[attr])) == dict(
+            zip(expected.vs["name"], expected.vs[attr])
+        )
+
+    # Citing back closes a cycle, a feedback arc set drops just one citation
+    cites = {(names[e.source], names[e.target]) for e in graph.es}
+    article, reference = next(
+        pair for pair in pairs if (pair[0].label, pair[1].label) in cites
+    )
+    looped = sapper.update(expected, [(reference, article)], loops=LOOPS_FEEDBACK)
+    assert looped.ecount() == expected.ecount()
+
+    # Approximate trees get all their counts out of a sample of the new graph
+    sampled = Sap(default_clear_graph=False, approximate=0.5)
+    updated = sampled.update(sampled.tree(old_graph), new_pairs)
+    regrown = sampled.tree(updated)
+    for attr in ("_connections", "_leaf_connections", "sap"):
+        assert updated.vs[attr] == regrown.vs[attr]
+
+
+def test_top_k_is_a_stable_reverse_sort():
+    """Top k selection breaks ties by index, like sorted(reverse=True)."""
+    values = [3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5, 2**70]
+    for k in (None, 0, 1, 3, 5, len(values)):
+        expected = sorted(range(len(values)), key=values.__getitem__, reverse=True)
+        assert top_k(values, k) == expected[:k]
+        assert top_k(values[:-1], k) == [i for i in expected if i < 11][:k]
+
+
+def test_sweep_matches_tree():
+    """Every combination of a sweep picks the same nodes as growing its tree."""
+    graph = _giant()
+    grid = {"max_roots": [3, None], "max_leaves": [5, 20], "max_trunk": [2, 10]}
+    rows = list(Sap(min_leaf_connections=None).sweep(graph, grid))
+    assert len(rows) == 8
+    for row in rows:
+        params = {name: row[name] for name in SWEEP_PARAMETERS}
+        tree = Sap(**params).tree(graph)
+        for part, attr in (("roots", "root"), ("trunk", "trunk"), ("leaves", "leaf")):
+            tags = tree.vs[attr]
+            expected = top_k(tags, sum(1 for value in tags if value > 0))
+            assert row[part] == [tree.vs[i]["name"] for i in expected]
+
+
+def test_trees_match_tree():
+    """Growing several configurations at once gives the trees of each one."""
+    graph = _giant()
+    sappers = {
+        "default": Sap(),
+        "short": Sap(max_trunk=3),
+        "narrow": Sap(max_roots=3, max_leaves=5, engine="numpy"),
+        "logs": Sap(numbers="log", default_clear_graph=False),
+        "sampled": Sap(approximate=0.2),
+        "empty": Sap(max_roots=0),
+    }
+    grown = trees(graph, sappers)
+    assert list(grown) == list(sappers)
+    assert grown.pop("empty") is None
+    for name, tree in grown.items():
+        expected = sappers[name].tree(graph)
+        assert tree.vs["name"] == expected.vs["name"]
+        for attr in ("root", "trunk", "leaf", "sap"):
+            assert tree.vs[attr] == expected.vs[attr]
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.main,
+        ["--no-cache", "describe", "-C", "a:max_trunk=3", "-C", "b", EXAMPLE],
+    )
+    assert result.exit_code == 0
+    assert "[0] a: IGRAPH" in result.output
+    assert "[0] b: IGRAPH" in result.output
+
+
+def test_approximate_tree_overlaps_exact_tree():
+    """Sampling keeps the roots and, with a tiny error, the whole tree."""
+    graph = _giant()
+    exact = Sap().tree(graph)
+    for engine in ENGINES:
+        tiny = Sap(approximate=1e-9, engine=engine).tree(graph)
+        for attr in ("root", "trunk", "leaf", "sap"):
+            assert tiny.vs[attr] == exact.vs[attr]
+    report = Sap(approximate=0.2).overlap(graph)
+    assert report["sampled_edges"] < report["edges"]
+    assert report["root"]["shared"] == report["root"]["exact"]
+    assert report["leaf"]["shared"] >= report["leaf"]["exact"] // 2
+
+    # Exact counts past the range of floats
+    doubling = _doubling(600)
+    exact = Sap(max_leaf_age=None).tree(doubling)
+    for engine in ENGINES:
+        tiny = Sap(approximate=1e-9, engine=engine, max_leaf_age=None).tree(doubling)
+        assert max(tiny.vs["sap"]) > 2**1024
+        assert all(
+            abs(estimate - count) * 10**9 <= count
+            for estimate, count in zip(tiny.vs["sap"], exact.vs["sap"])
+        )
+        rough = Sap(approximate=0.1, engine=engine, max_leaf_age=None).tree(doubling)
+        assert rough.vcount() > 0
+
+
+def test_profile_records_every_stage():
+    """A profile gets the stages of load and tree, in the order they ran."""
+    profile = Profile()
+    with open(EXAMPLE) as source:
+        graph = giant(Collection(source), profile=profile)
+    Sap().tree(graph, profile=profile)
+    assert [stage.name for stage in profile.stages] == [
+        "parse",
+        "preprocess",
+        "break_loops",
+        "components",
+        "component",
+        "copy",
+        "root",
+        "leaf",
+        "sap",
+        "trunk",
+        "clear",
+    ]
+    cleared = profile.stages[-1]
+    assert cleared.vertices_in == graph.vcount() > cleared.vertices_out
+
+
+def test_components_come_largest_first():
+    """Components come by size, without those lacking a citing cited article."""
+    graph = Graph(
+        n=10,
+        edges=[(0, 1), (1, 2), (3, 4), (4, 5), (5, 6), (7, 8)],
+        directed=True,
+        vertex_attrs={"name": list("abcdefghij")},
+    )
+    whole, *components = _with_components(graph)
+    assert whole is graph
+    assert [component.vs["name"] for component in components] == [
+        list("defg"),
+        list("abc"),
+    ]
+    with open(EXAMPLE) as source:
+        _, largest, *_ = load(Collection(source))
+    assert _giant().vs["name"] == largest.vs["name"]
+
+    # The command line grows the tree of the same component
+    bits = os.path.join(os.path.dirname(EXAMPLE), "bit-pattern-savedrecs.txt")
+    with open(bits) as source:
+        expected = Sap(default_clear_graph=False).tree(giant(Collection(source)))
+    result = CliRunner().invoke(
+        cli.main, ["--no-cache", "-w", "export", "-f", "csv", bits]
+    )
+    assert result.exit_code == 0
+    assert len(result.output.splitlines()) == 1 + expected.vcount()
+
+
+def test_compact_tree_matches_tree():
+    """A compact tree converts back to the same graph that tree returns."""
+    graph = _giant()
+    sapper = Sap()
+    tree = sapper.tree(graph)
+    compact = sapper.tree(graph, compact=True)
+    assert len(compact) == tree.vcount()
+    rebuilt = compact.to_graph(graph, "year")
+    for attr in ("name", "year", "root", "leaf", "trunk", "sap"):
+        assert rebuilt.vs[attr] == tree.vs[attr]
+    assert sorted(rebuilt.get_edgelist()) == sorted(tree.get_edgelist())
+    assert [compact.labels[i] for i in compact.ranked("leaf")] == [
+        tree.vs[i]["name"] for i in top_k(tree.vs["leaf"], len(compact.ranked("leaf")))
+    ]
+
+
+def test_binary_graph_round_trip(tmp_path):
+    """Binary graph files keep the edges and every vertex attribute."""
+    graph = _giant()
+    graph.vs[0]["year"] = None
+    path = str(tmp_path / "graph.sapg")
+    with open(path, "wb") as output:
+        binary.write(graph, output)
+    assert binary.is_graph_file(path) and not binary.is_graph_file(EXAMPLE)
+    loaded = binary.read(path)
+    assert loaded.get_edgelist() == graph.get_edgelist()
+    for attr in graph.vs.attributes():
+        assert loaded.vs[attr] == graph.vs[attr]
+
+
+def test_writers_keep_only_tagged_vertices(tmp_path):
+    """Writing only the tagged vertices of a whole tree gives the cleared tree."""
+    graph = _giant()
+    whole = Sap(default_clear_graph=False).tree(graph)
+    cleared = Sap().tree(graph)
+    output = io.StringIO()
+    writers.write(whole, output, writers.FORMAT_JSONL, tagged_only=True, chunk_size=7)
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [record["name"] for record in records] == cleared.vs["name"]
+    assert sorted(
+        (record["id"], cited) for record in records for cited in record["cites"]
+    ) == sorted(cleared.get_edgelist())
+
+    graphml = io.StringIO()
+    writers.write(
+        whole, graphml, writers.FORMAT_GRAPHML, tagged_only=True, chunk_size=7
+    )
+    path = tmp_path / "tree.graphml"
+    path.write_text(graphml.getvalue())
+    read = Graph.Read_GraphML(str(path))
+    assert read.vs["name"] == cleared.vs["name"]
+    assert read.vs["sap"] == cleared.vs["sap"]
+    assert sorted(read.get_edgelist()) == sorted(cleared.get_edgelist())
+
+
+def test_leaf_age_cut():
+    """Leaves can't be older than the newest leaf minus the max leaf age."""
+    graph = Sap().root(_giant())
+    unlimited = Sap(max_leaves=None, min_leaf_connections=None).leaf(graph)
+    sapper = Sap(max_leaf_age=3, max_leaves=None, min_leaf_connections=None)
+    leafed = sapper.leaf(graph)
+    assert "leaf" not in graph.vs.attributes()
+    newest = max(year for year in leafed.vs.select(_indegree=0)["year"] if year)
+    years = [v["year"] for v in leafed.vs if v["leaf"] > 0]
+    assert years and all(year is None or year >= newest - 3 for year in years)
+    assert any(v["year"] and v["year"] < newest - 3 for v in unlimited.vs if v["leaf"])
+
+
+def test_batch_reports_failures(tmp_path):
+    """A failing collection doesn't stop the rest of the batch."""
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text(
+        f"# two collections\n{EXAMPLE} trees/good.jsonl max_roots=5\n"
+        "missing.isi trees/bad.csv\n"
+    )
+    report = tmp_path / "report.jsonl"
+    result = CliRunner().invoke(
+        cli.main,
+        ["--cache-dir", str(tmp_path), "batch", str(manifest), "--report", str(report)],
+    )
+    assert result.exit_code == 1
+    outcomes = [json.loads(line) for line in report.read_text().splitlines()]
+    assert [outcome["status"] for outcome in outcomes] == ["ok", "failed"]
+    assert (tmp_path / "trees" / "good.jsonl").exists()
+    assert not (tmp_path / "trees" / "bad.csv").exists()
+
+
+def test_cli_imports_are_lazy():
+    """Importing the command line doesn't import numpy, igraph or wostools."""
+    script = (
+        "import sys, sap.cli, sap.widget; "
+        "print(any(name in sys.modules for name in ('numpy', 'igraph', 'wostools')))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    )
+    assert output.stdout.strip() == "False"
+
+    # Threads can be the first to use them
+    script = (
+        "import sap, threading; "
+        "threads = [threading.Thread(target=lambda: sap.np.zeros(3)) "
+        "for _ in range(8)]; "
+        "threading.excepthook = lambda args: print(args.exc_value); "
+        "[thread.start() for thread in threads]; "
+        "[thread.join() for thread in threads]"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    )
+    assert output.stdout == ""
+
+
+def test_widget_pages_cover_every_article():
+    """The pages of a widget show, between them, every article of the tree."""
+    tree = Sap().tree(_giant())
+
+    def ids(html):
+        return re.findall(r'<div class="Article" id="([^"]*)"', html)
+
+    whole = ids(Widget(tree, limit=None)._repr_html_())
+    pages = [Widget(tree, limit=10, page=page)._repr_html_() for page in range(5)]
+    assert "Article-more" in pages[0]
+    assert sorted(sum((ids(html) for html in pages), [])) == sorted(whole)
+
+    # Exact counts past the range of floats
+    deep = Sap(max_leaf_age=None).tree(_doubling(600))
+    assert max(deep.vs["sap"]) > 2**1024
+    html = Widget(deep, limit=None)._repr_html_()
+    assert html.count('<div class="Article"') == deep.vcount()
+
+
+def test_server_grows_and_keeps_trees(tmp_path):
+    """The server answers with the tree and keeps it for the next requests."""
+    with open(EXAMPLE, "rb") as source:
+        records = source.read()
+
+    async def request(port, head, body=b""):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"{head}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        status = (await reader.readline()).split()[1]
+        content = (await reader.read()).split(b"\r\n\r\n", 1)[1]
+        writer.close()
+        return int(status), content
+
+    async def scenario():
+        server = Server(Sap(), cache=GraphCache(str(tmp_path)), workers=1)
+        listening = await server.start("127.0.0.1", 0)
+        port = listening.sockets[0].getsockname()[1]
+        try:
+            post = "POST /tree?max_roots=5 HTTP/1.1"
+            status, content = await request(port, post, records)
+            tree = json.loads(content)
+            again = await request(port, post, records)
+            key = tree["collection"]
+            html = await request(port, f"GET /tree/{key}?format=html HTTP/1.1")
+            unknown = await request(port, f"GET /tree/{'0' * 64} HTTP/1.1")
+        finally:
+            listening.close()
+            server.close()
+        return status, tree, again, html, unknown, server
+
+    status, tree, again, html, unknown, server = asyncio.run(scenario())
+    expected = Sap(max_roots=5).tree(_giant())
+    assert status == 200
+    assert [root["label"] for root in tree["root"]] == [
+        expected.vs[i]["label"] for i in top_k(expected.vs["root"], 5)
+    ]
+    assert again == (200, json.dumps(tree).encode())
+    assert html[0] == 200 and b'class="Article"' in html[1]
+    assert unknown[0] == 404
+    assert len(server.trees) == 2
+    # A large collection can't take the only worker
+    assert server.workers == 2
+    assert server.sizes[tree["collection"]] == len(records)